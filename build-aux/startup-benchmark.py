@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# startup-benchmark.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Launch Valuta headless and report time-to-first-result percentiles.
+
+Cold runs start with an empty rate cache, warm runs share a cache filled by a
+first untimed launch. Every run gets its own D-Bus session and, when no
+display is available, its own virtual X server through xvfb-run.
+
+    build-aux/startup-benchmark.py --runs 20 --bin _build/src/valuta
+"""
+
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = (len(values) - 1) * percent / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+def command(binary, report):
+    args = [binary, '--profile-startup', report]
+    if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        if not shutil.which('xvfb-run'):
+            sys.exit('No display available and xvfb-run was not found')
+        args = ['xvfb-run', '-a', *args]
+    if shutil.which('dbus-run-session'):
+        args = ['dbus-run-session', '--', *args]
+    return args
+
+def launch(binary, cache_dir, timeout):
+    with tempfile.TemporaryDirectory() as run_dir:
+        report = os.path.join(run_dir, 'startup.json')
+        env = {
+            **os.environ,
+            'XDG_CACHE_HOME': cache_dir,
+            'GSETTINGS_BACKEND': 'memory',
+        }
+        process = subprocess.Popen(command(binary, report), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        try:
+            while not os.path.exists(report):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    return None
+                time.sleep(0.01)
+            with open(report, encoding='utf-8') as file:
+                return json.load(file)
+        finally:
+            process.terminate()
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def summary(name, reports):
+    totals = [report['total_ms'] for report in reports]
+    phases = {}
+    for report in reports:
+        for phase in report['phases']:
+            phases.setdefault(phase['name'], []).append(phase['duration_ms'] or phase['start_ms'])
+    print(f'{name}: {len(totals)} runs')
+    for percent in (50, 90, 99):
+        print(f'  p{percent} time-to-first-result: {percentile(totals, percent):.1f} ms')
+    for phase, values in phases.items():
+        print(f'  {phase:<20} p50 {percentile(values, 50):8.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold and warm startup benchmark')
+    parser.add_argument('--bin', default='valuta', help='Valuta launcher to run')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', help='Also write every report to this file')
+    args = parser.parse_args()
+
+    cold = []
+    for _run in range(args.runs):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            report = launch(args.bin, cache_dir, args.timeout)
+            if report:
+                cold.append(report)
+
+    warm = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        launch(args.bin, cache_dir, args.timeout)
+        for _run in range(args.runs):
+            report = launch(args.bin, cache_dir, args.timeout)
+            if report:
+                warm.append(report)
+
+    summary('cold', cold)
+    summary('warm', warm)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'cold': cold, 'warm': warm}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
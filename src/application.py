@@ -25,10 +25,12 @@ gi.require_version("Adw", "1")
 
 from gi.repository import Adw, GObject, Gio, GLib, Gtk
 from .utils import Utils
+from .scheduler import RefreshScheduler
+from .profiling import metrics, tracer
 from .window import create_main_window
 from .actions import application_actions
 
-from .define import APP_ID, VERSION, RES_PATH
+from .define import APP_ID, VERSION, RES_PATH, currencies
 
 class Application(Adw.Application):
     """The main application singleton class."""
@@ -40,17 +42,41 @@ class Application(Adw.Application):
                 resource_base_path=RES_PATH,
                 flags=Gio.ApplicationFlags.HANDLES_COMMAND_LINE
             )
-        self.utils = Utils(APP_ID)
+        with tracer.phase('utils'):
+            self.utils = Utils(APP_ID)
+        self.scheduler = RefreshScheduler(self.utils.settings, self.utils.convertion.rates)
         application_actions(application=self)
         self.from_currency_value = 0
         self.add_main_option('src-currency-value', b't', GLib.OptionFlags.NONE,
                              GLib.OptionArg.STRING, 'Value to convert currencies', None)
+        self.add_main_option('src-currency', 0, GLib.OptionFlags.NONE,
+                             GLib.OptionArg.STRING, 'Currency to convert from', 'CODE')
+        self.add_main_option('dest-currency', 0, GLib.OptionFlags.NONE,
+                             GLib.OptionArg.STRING, 'Currency to convert into', 'CODE')
+        self.add_main_option('profile-startup', 0, GLib.OptionFlags.NONE,
+                             GLib.OptionArg.STRING, 'Write startup phases as JSON to FILE', 'FILE')
+
+    def do_startup(self):
+        Adw.Application.do_startup(self)
+        self.scheduler.start()
+
+    def do_dbus_register(self, connection, object_path):
+        if metrics.enabled:
+            metrics.register_dbus(connection, object_path)
+        return Adw.Application.do_dbus_register(self, connection, object_path)
+
+    def do_shutdown(self):
+        self.scheduler.stop()
+        metrics.flush()
+        Adw.Application.do_shutdown(self)
 
     def do_activate(self):
         if self.get_active_window() is not None:
             self.get_active_window().present()
         else:
-            create_main_window(self, self.from_currency_value).present()
+            with tracer.phase('window'):
+                window = create_main_window(self, self.from_currency_value)
+            window.present()
 
     def do_command_line(self, command_line):
         options = command_line.get_options_dict()
@@ -58,6 +84,12 @@ class Application(Adw.Application):
         src_currency_value = ''
         if 'src-currency-value' in options:
             src_currency_value = options['src-currency-value']
+        if 'profile-startup' in options:
+            tracer.enable(options['profile-startup'])
+        for key in ('src-currency', 'dest-currency'):
+            code = options.get(key, '').upper()
+            if code in currencies() and self.utils.settings.get_string(key) != code:
+                self.utils.settings.set_string(key, code)
         if self.get_active_window() is not None:
             self.get_active_window().load_convertion_page(src_currency_value)
         else:
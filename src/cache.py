@@ -0,0 +1,66 @@
+# cache.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Dict, Optional, Tuple
+import json, os, tempfile
+from gi.repository import GLib
+
+CACHE_VERSION = 2
+
+class RateCache:
+    """ Rate tables on disk, shared by the application and the search provider """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(GLib.get_user_cache_dir(), 'valuta', f'rates-v{CACHE_VERSION}')
+
+    def path(self, provider: int, base: str) -> str:
+        return os.path.join(self.directory, f'{provider}-{base}.json')
+
+    def stamp(self, provider: int, base: str) -> Optional[Tuple[int, int, int]]:
+        """ Changes whenever the file is written again, None when there is no file """
+        try:
+            stat = os.stat(self.path(provider, base))
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self, provider: int, base: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path(provider, base), 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != CACHE_VERSION:
+            return None
+        return data
+
+    def save(self, provider: int, base: str, data: Dict[str, Any]):
+        """ Write the table atomically, readers never see a partial file """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f'.{provider}-{base}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    json.dump({**data, 'version': CACHE_VERSION}, file)
+                os.replace(temp_path, self.path(provider, base))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            pass
@@ -0,0 +1,243 @@
+# cli.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Headless bulk conversion, GTK is never imported.
+
+    valuta convert --from USD --to EUR --input ledger.csv --column amount
+    valuta convert --from USD --to EUR --input ledger.jsonl --column amount --date-column booked
+
+Rows are read, converted and written in chunks, so memory stays bounded whatever the input size.
+"""
+
+from array import array
+from datetime import date
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+import argparse, csv, json, math, sys, time
+from .define import currencies, minor_units
+from .rates import RateEngine, RateError, RateTable
+from .history import RateHistory
+from .requests import RequestError, providers
+
+CHUNK_ROWS = 8192
+JSONL_SUFFIXES = ('.jsonl', '.ndjson')
+NOT_FINITE = frozenset(('nan', '-nan', 'inf', '-inf'))
+
+def provider_ids() -> Dict[str, int]:
+    return {provider.__name__.lower(): provider_id for provider_id, provider in providers.items()}
+
+def parse_amount(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+class Converter:
+    """ Amounts of one currency into another, at the latest rate or at the rate in force on each row's date """
+    MAX_CACHED_DATES: int = 4096
+
+    def __init__(self, from_currency: str, to_currency: str, digits: int, table: Optional[RateTable] = None, history: Optional[RateHistory] = None):
+        self.from_currency = from_currency
+        self.to_currency = to_currency
+        self.table = table
+        self.history = history
+        self.format = f'{{:.{digits}f}}'.format
+        self.rates: Dict[str, float] = {}
+        self.failed = 0
+
+    def rate_on(self, value) -> float:
+        """ Rates are cached per date string, ledgers repeat the same days """
+        day = str(value)[:10]
+        rate = self.rates.get(day)
+        if rate is None:
+            if len(self.rates) >= self.MAX_CACHED_DATES:
+                self.rates.clear()
+            try:
+                rate = self.history.rate(self.to_currency, date.fromisoformat(day))
+            except ValueError:
+                rate = None
+            rate = self.rates[day] = math.nan if rate is None else rate
+        return rate
+
+    def convert(self, amounts: array, dates: Optional[List] = None) -> List[str]:
+        if dates is None:
+            values = self.table.convert_many(amounts, self.from_currency, self.to_currency).values[0]
+        else:
+            values = map(float.__mul__, amounts, array('d', map(self.rate_on, dates)))
+        results = list(map(self.format, values))
+        for index, value in enumerate(results):
+            if value in NOT_FINITE:
+                results[index] = ''
+                self.failed += 1
+        return results
+
+def chunks(rows: Iterable, size: int = CHUNK_ROWS) -> Iterator[List]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def convert_csv(source: TextIO, output: TextIO, converter: Converter, column: str, output_column: str, date_column: Optional[str], delimiter: str) -> int:
+    reader = csv.reader(source, delimiter=delimiter)
+    writer = csv.writer(output, delimiter=delimiter, lineterminator='\n')
+    header = next(reader, None)
+    if header is None:
+        return 0
+
+    def index(name: str) -> int:
+        if name in header:
+            return header.index(name)
+        if name.isdigit() and int(name) < len(header):
+            return int(name)
+        raise SystemExit(f'valuta convert: no column {name!r} in {", ".join(header)}')
+
+    amount_index = index(column)
+    date_index = index(date_column) if date_column else None
+    writer.writerow(header + [output_column])
+    count = 0
+    for chunk in chunks(reader):
+        amounts = array('d', [parse_amount(row[amount_index]) if len(row) > amount_index else math.nan for row in chunk])
+        dates = [row[date_index] if len(row) > date_index else '' for row in chunk] if date_index is not None else None
+        for row, value in zip(chunk, converter.convert(amounts, dates)):
+            row.append(value)
+        writer.writerows(chunk)
+        count += len(chunk)
+    return count
+
+def parse_object(line: str) -> Optional[dict]:
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    return row if isinstance(row, dict) else None
+
+def convert_jsonl(source: TextIO, output: TextIO, converter: Converter, column: str, output_column: str, date_column: Optional[str]) -> int:
+    """ Lines that are not JSON objects are counted as failed and passed through as {"line": text, output_column: null} """
+    dumps = json.dumps
+    # The converted amounts are written as JSON numbers with the digits they were formatted with
+    null = dumps(None)
+    count = 0
+    for chunk in chunks(line for line in source if line.strip()):
+        rows = [parse_object(line) for line in chunk]
+        valid = [row for row in rows if row is not None]
+        amounts = array('d', [parse_amount(row.get(column)) for row in valid])
+        dates = [row.get(date_column, '') for row in valid] if date_column else None
+        values = iter(converter.convert(amounts, dates))
+        lines = []
+        for line, row in zip(chunk, rows):
+            if row is None:
+                converter.failed += 1
+                row, value = {'line': line.rstrip('\r\n')}, null
+            else:
+                value = next(values) or null
+            row.pop(output_column, None)
+            body = dumps(row, ensure_ascii=False)
+            separator = ', ' if len(body) > 2 else ''
+            lines.append(f'{body[:-1]}{separator}{dumps(output_column, ensure_ascii=False)}: {value}}}\n')
+        output.write(''.join(lines))
+        count += len(rows)
+    return count
+
+def load_table(engine: RateEngine, provider: int, from_currency: str, to_currency: str, offline: bool) -> RateTable:
+    """ The stored table, refreshed when expired unless offline, an expired one still beats no answer """
+    table = engine.lookup(provider, from_currency, to_currency, stale=True)
+    if table is not None and (table.fresh or offline):
+        return table
+    if offline:
+        raise SystemExit(f'valuta convert: no stored rates for {from_currency} to {to_currency}')
+    try:
+        return engine.get(provider, from_currency, to_currency)
+    except RateError as error:
+        if table is None:
+            raise SystemExit(f'valuta convert: {error.message}')
+        print(f'valuta convert: using rates of {table.date}, {error.message}', file=sys.stderr)
+        return table
+
+def load_history(engine: RateEngine, provider: int, from_currency: str, offline: bool) -> RateHistory:
+    if not offline:
+        try:
+            return engine.history.update(provider, from_currency)
+        except (RequestError, OSError) as error:
+            print(f'valuta convert: history not updated, {error}', file=sys.stderr)
+    return engine.history.history(provider, from_currency)
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='valuta convert', description='Convert a column of amounts in a CSV or JSON Lines file.')
+    parser.add_argument('--from', dest='from_currency', required=True, type=str.upper, help='currency of the amounts')
+    parser.add_argument('--to', dest='to_currency', required=True, type=str.upper, help='currency to convert into')
+    parser.add_argument('--input', default='-', help='file to read, - for standard input')
+    parser.add_argument('--output', default='-', help='file to write, - for standard output')
+    parser.add_argument('--column', required=True, help='name (or CSV index) of the amount column')
+    parser.add_argument('--output-column', help='name of the added column, defaults to COLUMN_TO')
+    parser.add_argument('--date-column', help='convert at the rate in force on the date of each row')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='input format, guessed from the file name')
+    parser.add_argument('--delimiter', default=',', help='CSV field delimiter')
+    parser.add_argument('--decimals', type=int, help='digits after the decimal point, defaults to the minor unit of the target')
+    parser.add_argument('--provider', default='ecb', choices=sorted(provider_ids()))
+    parser.add_argument('--offline', action='store_true', help='only use stored rates')
+    parser.add_argument('--verbose', action='store_true', help='report throughput on standard error')
+    return parser
+
+def open_text(path: str, mode: str, fallback: TextIO) -> TextIO:
+    if path == '-':
+        return fallback
+    return open(path, mode, encoding='utf-8', newline='')
+
+def main(argv: List[str]) -> int:
+    args = parser().parse_args(argv)
+    for code in (args.from_currency, args.to_currency):
+        if code not in currencies():
+            raise SystemExit(f'valuta convert: unknown currency {code}')
+    provider = provider_ids()[args.provider]
+    digits = args.decimals if args.decimals is not None else minor_units(args.to_currency)
+    engine = RateEngine()
+    if args.date_column:
+        history = load_history(engine, provider, args.from_currency, args.offline)
+        converter = Converter(args.from_currency, args.to_currency, digits, history=history)
+    else:
+        table = load_table(engine, provider, args.from_currency, args.to_currency, args.offline)
+        converter = Converter(args.from_currency, args.to_currency, digits, table=table)
+    output_column = args.output_column or f'{args.column}_{args.to_currency}'
+    input_format = args.format or ('jsonl' if args.input.endswith(JSONL_SUFFIXES) else 'csv')
+
+    start = time.perf_counter()
+    source = open_text(args.input, 'r', sys.stdin)
+    output = open_text(args.output, 'w', sys.stdout)
+    try:
+        if input_format == 'jsonl':
+            count = convert_jsonl(source, output, converter, args.column, output_column, args.date_column)
+        else:
+            count = convert_csv(source, output, converter, args.column, output_column, args.date_column, args.delimiter)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+
+    if converter.failed:
+        print(f'valuta convert: {converter.failed} of {count} rows could not be converted', file=sys.stderr)
+    if args.verbose:
+        elapsed = time.perf_counter() - start
+        print(f'valuta convert: {count} rows in {elapsed:.2f}s, {count / max(elapsed, 1e-9):.0f} rows/s', file=sys.stderr)
+    return 0
@@ -19,3 +19,4 @@
 
 from .currency_selector.currency_selector import CurrencySelector
 from .shortcuts.shortcuts import Shortcuts
+from .trend_chart.trend_chart import TrendChart
@@ -17,11 +17,9 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-
-
-import re
 from gi.repository import Adw, Gdk, GObject, Gtk
 from ..currency_selector_row.currency_selector_row import CurrencySelectorRow
+from ...utils import CurrencyObject, CurrencySearchIndex
 
 @Gtk.Template(resource_path='/io/github/idevecore/Valuta/components/currency_selector/index.ui')
 class CurrencySelector(Adw.Bin):
@@ -42,19 +40,50 @@ class CurrencySelector(Adw.Bin):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.model = None
+        self.rows = {}
+        self.selected_code = None
+        self.search_index = None
+        self.query = ''
+        self.filter_model = None
+        # Recently used first, then by name; the string sorter keeps a native collation key per item
+        self.recent_sorter = Gtk.NumericSorter.new(Gtk.PropertyExpression.new(CurrencyObject, None, 'recent'))
+        self.recent_sorter.set_sort_order(Gtk.SortType.ASCENDING)
+        name_sorter = Gtk.StringSorter.new(Gtk.PropertyExpression.new(CurrencyObject, None, 'name'))
+        name_sorter.set_ignore_case(True)
+        name_sorter.set_collation(Gtk.Collation.UNICODE)
+        self.sorter = Gtk.MultiSorter()
+        self.sorter.append(self.recent_sorter)
+        self.sorter.append(name_sorter)
+        self.filter = Gtk.CustomFilter()
+        self.filter.set_filter_func(self.filter_currencies)
+        factory = Gtk.SignalListItemFactory()
+        factory.connect('setup', self._on_factory_setup)
+        factory.connect('bind', self._on_factory_bind)
+        factory.connect('unbind', self._on_factory_unbind)
+        self.currency_list.set_factory(factory)
         self.search.set_key_capture_widget(self.popover)
         key_events = Gtk.EventControllerKey.new()
         key_events.connect('key-pressed', self.on_key_pressed)
         self.search.add_controller(key_events)
 
     def bind_models(self, currencies):
+        """ The list itself is only populated once the popover is opened """
         self.model = currencies
-        self.filter = Gtk.CustomFilter()
-        self.filter.set_filter_func(self.filter_currencies)
-        sorter = Gtk.CustomSorter.new(self.sort_currencies)
-        sorted_model = Gtk.SortListModel.new(model=self.model, sorter=sorter)
-        filter_model = Gtk.FilterListModel.new(sorted_model, self.filter)
-        self.currency_list.bind_model(filter_model, self.create_currency_row)
+        if self.filter_model is not None and self.filter_model.get_model().get_model() is currencies:
+            return
+        self.search_index = None
+        self.filter_model = None
+        self.currency_list.set_model(None)
+        if self.popover.get_visible():
+            self.populate()
+
+    def populate(self):
+        if self.filter_model is not None or self.model is None:
+            return
+        self.search_index = self.model.get_search_index()
+        sorted_model = Gtk.SortListModel.new(model=self.model, sorter=self.sorter)
+        self.filter_model = Gtk.FilterListModel.new(sorted_model, self.filter)
+        self.currency_list.set_model(Gtk.NoSelection.new(self.filter_model))
 
     def set_insight(self, code):
         if self.selected == 'auto':
@@ -66,26 +95,40 @@ class CurrencySelector(Adw.Bin):
     @Gtk.Template.Callback()
     def _on_selected_changed(self, _self, _pspec):
         if self.model is not None:
-            self.model.set_selected(self.selected)
+            self.update_selection()
             self.label.props.label = self.selected
             self.insight.props.label = ''
 
     def set_selected(self, code):
         if self.model is not None:
             self.selected = code
-            self.model.set_selected(self.selected)
+            self.update_selection()
             self.label.props.label = self.selected
             self.insight.props.label = ''
 
+    def update_selection(self):
+        """ The selection belongs to this selector, only the old and new visible rows change """
+        previous, self.selected_code = self.selected_code, self.selected
+        if previous == self.selected_code:
+            return
+        if previous in self.rows:
+            self.rows[previous].set_selected(False)
+        if self.selected_code in self.rows:
+            self.rows[self.selected_code].set_selected(True)
+
 
     @Gtk.Template.Callback()
-    def _activated(self, _list, row):
+    def _activated(self, _list, position):
+        currency = self.filter_model.get_item(position)
+        if currency is None:
+            return
         self.popover.popdown()
-        self.selected = row.currency.code
+        self.selected = currency.code
         self.emit('user-selection-changed')
 
     @Gtk.Template.Callback()
     def _popover_show(self, _popover):
+        self.populate()
         self.search.grab_focus()
 
     @Gtk.Template.Callback()
@@ -95,27 +138,44 @@ class CurrencySelector(Adw.Bin):
         self.search.props.text = ''
   
     def filter_currencies(self, item):
-        search = self.search.get_text()
-        return bool(re.search(search, f'{item} - {item.name}', re.IGNORECASE))
+        return self.search_index is None or self.search_index.match(item.code, self.query)
+
+    def resort(self):
+        self.recent_sorter.changed(Gtk.SorterChange.DIFFERENT)
+
+    def _on_factory_setup(self, _factory, list_item):
+        list_item.set_child(CurrencySelectorRow())
 
-    def sort_currencies(self, currency_a, currency_b, _data):
-        a = currency_a.name.lower()
-        b = currency_b.name.lower()
-        return (a > b) - (a < b)
+    def _on_factory_bind(self, _factory, list_item):
+        currency = list_item.get_item()
+        row = list_item.get_child()
+        row.bind(currency, currency.code == self.selected_code)
+        self.rows[currency.code] = row
 
-    def create_currency_row(self, currency):
-        return CurrencySelectorRow(currency)
+    def _on_factory_unbind(self, _factory, list_item):
+        row = list_item.get_child()
+        if row.currency is not None and self.rows.get(row.currency.code) is row:
+            del self.rows[row.currency.code]
+        row.unbind()
 
     @Gtk.Template.Callback()
     def _on_search(self, _entry):
-        self.filter.emit('changed', Gtk.FilterChange.DIFFERENT)
+        query = CurrencySearchIndex.normalize(self.search.get_text().strip())
+        previous, self.query = self.query, query
+        if query == previous or self.filter_model is None:
+            return
+        # Only the items still shown (or still hidden) need to be checked again
+        if previous in query:
+            self.filter.changed(Gtk.FilterChange.MORE_STRICT)
+        elif query in previous:
+            self.filter.changed(Gtk.FilterChange.LESS_STRICT)
+        else:
+            self.filter.changed(Gtk.FilterChange.DIFFERENT)
 
     @Gtk.Template.Callback()
     def _on_search_activate(self, _entry):
-        if self.search.props.text:
-            row = self.currency_list.get_row_at_index(0)
-            if row:
-                self.currency_list.emit('row-activated', row)
+        if self.search.props.text and self.filter_model is not None and self.filter_model.get_n_items():
+            self._activated(self.currency_list, 0)
         return Gdk.EVENT_PROPAGATE
 
     def on_key_pressed(self,_controller, keyval, _keycode, _mod):
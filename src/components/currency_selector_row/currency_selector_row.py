@@ -17,26 +17,27 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import textwrap
-from gi.repository import GObject, Gtk
-from ...define import CODES
+from gi.repository import Gtk
 
 @Gtk.Template(resource_path='/io/github/idevecore/Valuta/components/currency_selector_row/index.ui')
-class CurrencySelectorRow(Gtk.ListBoxRow):
+class CurrencySelectorRow(Gtk.Box):
+    """ Recycled by the selector list view, bound to a new currency as it scrolls into view """
     __gtype_name__ = 'CurrencySelectorRow'
 
     name = Gtk.Template.Child()
     selection = Gtk.Template.Child()
-    
-    def __init__(self, currency):
+
+    def __init__(self):
         super().__init__()
+        self.currency = None
+
+    def bind(self, currency, selected: bool):
         self.currency = currency
-        #self.name.props.label = f'{CODES[str(self.currency)]["flag"]}   {self.currency} – {self.currency.name}'
-        self.name.props.label = f'{self.currency} – {textwrap.shorten(self.currency.name, width=30, placeholder="...")}'
+        self.name.props.label = f'{currency} – {currency.name}'
+        self.set_selected(selected)
+
+    def set_selected(self, selected: bool):
+        self.selection.set_visible(selected)
 
-        self.currency.bind_property(
-            'selected',
-            self.selection,
-            'visible',
-            GObject.BindingFlags.SYNC_CREATE
-        )
+    def unbind(self):
+        self.currency = None
@@ -0,0 +1,113 @@
+# trend_chart.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from bisect import bisect_left
+from datetime import date
+from typing import List, Sequence, Tuple
+import cairo, math
+from gi.repository import GLib, Gtk
+
+def lttb(xs: Sequence[float], ys: Sequence[float], threshold: int) -> Tuple[List[float], List[float]]:
+    """ Largest-Triangle-Three-Buckets, keeps threshold points preserving the visual shape of the series """
+    length = len(xs)
+    if threshold >= length or threshold < 3:
+        return list(xs), list(ys)
+    sampled_xs, sampled_ys = [xs[0]], [ys[0]]
+    every = (length - 2) / (threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        count = next_end - end
+        average_x = sum(xs[end:next_end]) / count
+        average_y = sum(ys[end:next_end]) / count
+        x, y = xs[selected], ys[selected]
+        largest = -1.0
+        for index in range(start, end):
+            area = abs((x - average_x) * (ys[index] - y) - (x - xs[index]) * (average_y - y))
+            if area > largest:
+                largest = area
+                selected = index
+        sampled_xs.append(xs[selected])
+        sampled_ys.append(ys[selected])
+    sampled_xs.append(xs[-1])
+    sampled_ys.append(ys[-1])
+    return sampled_xs, sampled_ys
+
+class TrendChart(Gtk.DrawingArea):
+    """ Line chart of a rate series, downsampled to one point per horizontal pixel """
+    __gtype_name__ = 'TrendChart'
+    PADDING: int = 4
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.xs: List[float] = []
+        self.ys: List[float] = []
+        self.format_func = lambda rate: f'{rate:.4f}'
+        self.__sampled = ([], [])
+        self.__sampled_width = 0
+        self.set_draw_func(self.on_draw)
+        self.set_has_tooltip(True)
+        self.connect('query-tooltip', self.on_query_tooltip)
+
+    def set_series(self, dates: Sequence[int], rates: Sequence[float]):
+        """ Day ordinals and rates, days without a rate are left out """
+        self.xs = [day for day, rate in zip(dates, rates) if not math.isnan(rate)]
+        self.ys = [rate for rate in rates if not math.isnan(rate)]
+        self.__sampled_width = 0
+        self.queue_draw()
+
+    def sampled(self, width: int) -> Tuple[List[float], List[float]]:
+        if self.__sampled_width != width:
+            self.__sampled = lttb(self.xs, self.ys, width)
+            self.__sampled_width = width
+        return self.__sampled
+
+    def on_draw(self, area: Gtk.DrawingArea, context: cairo.Context, width: int, height: int):
+        xs, ys = self.sampled(max(width - 2 * self.PADDING, 3))
+        if len(xs) < 2:
+            return
+        low, high = min(ys), max(ys)
+        x_scale = (width - 2 * self.PADDING) / ((xs[-1] - xs[0]) or 1)
+        y_scale = (height - 2 * self.PADDING) / ((high - low) or 1)
+        color = self.get_color()
+
+        context.set_line_width(2)
+        context.set_line_join(cairo.LINE_JOIN_ROUND)
+        context.move_to(self.PADDING, height - self.PADDING - (ys[0] - low) * y_scale)
+        for x, y in zip(xs, ys):
+            context.line_to(self.PADDING + (x - xs[0]) * x_scale, height - self.PADDING - (y - low) * y_scale)
+        context.set_source_rgba(color.red, color.green, color.blue, color.alpha)
+        context.stroke_preserve()
+        context.line_to(width - self.PADDING, height)
+        context.line_to(self.PADDING, height)
+        context.close_path()
+        context.set_source_rgba(color.red, color.green, color.blue, color.alpha * 0.12)
+        context.fill()
+
+    def on_query_tooltip(self, widget: Gtk.Widget, x: int, y: int, keyboard: bool, tooltip: Gtk.Tooltip) -> bool:
+        if len(self.xs) < 2:
+            return False
+        day = self.xs[0] + (x - self.PADDING) / max(self.get_width() - 2 * self.PADDING, 1) * (self.xs[-1] - self.xs[0])
+        index = min(bisect_left(self.xs, day), len(self.xs) - 1)
+        published = date.fromordinal(int(self.xs[index]))
+        label = GLib.DateTime.new_local(published.year, published.month, published.day, 0, 0, 0).format('%x')
+        tooltip.set_text(f'{label}: {self.format_func(self.ys[index])}')
+        return True
@@ -0,0 +1,275 @@
+# history.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import fcntl, math, mmap, os
+from gi.repository import Gio, GLib
+from .requests import RequestError, providers
+from .profiling import metrics
+
+HISTORY_VERSION = 1
+DATES = 'dates.i32'
+COLUMN_SUFFIX = '.f64'
+LOCK = 'append.lock'
+EMPTY_DATES = memoryview(array('i'))
+EMPTY_RATES = memoryview(array('d'))
+
+def map_file(path: str, typecode: str) -> memoryview:
+    """ Read-only view of a file of native machine values, without copying it into memory """
+    try:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            size -= size % array(typecode).itemsize
+            if not size:
+                return memoryview(array(typecode))
+            return memoryview(mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)).cast(typecode)
+    except OSError:
+        return memoryview(array(typecode))
+
+class RateHistory:
+    """ Daily rates of one provider and base currency.
+
+    Dates are day ordinals in one int32 column, every currency is a float64 column aligned with it,
+    NaN marking the days it was not quoted. Columns are written before the dates on append,
+    so the dates column decides how many rows a reader sees.
+    """
+
+    def __init__(self, provider: int, base: str, directory: str):
+        self.provider = provider
+        self.base = base
+        self.directory = directory
+        self.__columns: Dict[str, memoryview] = {}
+        self.__size = -1
+        self.dates = EMPTY_DATES
+        self.reload()
+
+    def reload(self) -> bool:
+        """ Map the files again when another writer grew them, returns whether anything changed """
+        try:
+            size = os.stat(os.path.join(self.directory, DATES)).st_size
+        except OSError:
+            size = 0
+        if size == self.__size:
+            return False
+        self.__size = size
+        self.dates = map_file(os.path.join(self.directory, DATES), 'i')
+        self.__columns = {}
+        return True
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.codes()
+
+    def codes(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name[:-len(COLUMN_SUFFIX)] for name in names if name.endswith(COLUMN_SUFFIX)]
+
+    @property
+    def first(self) -> Optional[date]:
+        return date.fromordinal(self.dates[0]) if self.dates else None
+
+    @property
+    def last(self) -> Optional[date]:
+        return date.fromordinal(self.dates[-1]) if self.dates else None
+
+    def column(self, code: str) -> memoryview:
+        column = self.__columns.get(code)
+        if column is None:
+            if code == self.base:
+                column = memoryview(array('d', [1.0]) * len(self.dates))
+            else:
+                column = map_file(os.path.join(self.directory, code + COLUMN_SUFFIX), 'd')[:len(self.dates)]
+            self.__columns[code] = column
+        return column
+
+    def covers(self, day: date) -> bool:
+        return bool(self.dates) and self.dates[0] <= day.toordinal() <= self.dates[-1]
+
+    def lookup(self, code: str, day: date, exact: bool = False) -> Optional[Tuple[date, float]]:
+        """ Publication day and rate in force on day, that is the last one published on or before it """
+        index = bisect_right(self.dates, day.toordinal()) - 1
+        if index < 0 or (exact and self.dates[index] != day.toordinal()):
+            return None
+        column = self.column(code)
+        if index >= len(column) or math.isnan(column[index]):
+            return None
+        return date.fromordinal(self.dates[index]), column[index]
+
+    def rate(self, code: str, day: date, exact: bool = False) -> Optional[float]:
+        found = self.lookup(code, day, exact)
+        return found[1] if found is not None else None
+
+    def series(self, code: str, start: Optional[date] = None, end: Optional[date] = None) -> Tuple[memoryview, memoryview]:
+        """ Dates and rates from start to end, both included, as views of the mapped columns """
+        low = bisect_left(self.dates, start.toordinal()) if start else 0
+        high = bisect_right(self.dates, end.toordinal()) if end else len(self.dates)
+        column = self.column(code)
+        if len(column) < high:
+            return EMPTY_DATES, EMPTY_RATES
+        return self.dates[low:high], column[low:high]
+
+    def append(self, rows: Iterable[Tuple[str, Dict[str, float]]]) -> int:
+        """ Add the days after the last one stored, returns how many were added.
+
+        The app and the search provider both append, so the whole append holds a lock
+        and starts from what is on disk rather than from the last reload.
+        """
+        rows = sorted(((date.fromisoformat(day).toordinal(), rates) for day, rates in rows), key=lambda row: row[0])
+        if not rows:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK), 'ab') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            self.reload()
+            last = self.dates[-1] if self.dates else 0
+            rows = [(ordinal, rates) for ordinal, rates in rows if ordinal > last]
+            if not rows:
+                return 0
+            size = len(self.dates)
+            codes = set(self.codes())
+            for _ordinal, rates in rows:
+                codes.update(code for code in rates if code != self.base)
+            for code in codes:
+                path = os.path.join(self.directory, code + COLUMN_SUFFIX)
+                with open(path, 'ab') as file:
+                    # Drop what an interrupted append left past the last committed row, pad new currencies
+                    stored = file.tell() // 8
+                    if stored > size:
+                        file.truncate(size * 8)
+                    elif stored < size:
+                        file.write(array('d', [math.nan]) * (size - stored))
+                    array('d', (float(rates.get(code, math.nan)) for _ordinal, rates in rows)).tofile(file)
+            with open(os.path.join(self.directory, DATES), 'ab') as file:
+                file.truncate(size * 4)
+                array('i', (ordinal for ordinal, _rates in rows)).tofile(file)
+            self.reload()
+        metrics.count('history.rows', len(rows))
+        return len(rows)
+
+class HistoryStore:
+    """ Rate histories on disk, filled from the date range endpoint of each provider """
+    CHUNK_DAYS: int = 366
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(GLib.get_user_cache_dir(), 'valuta', f'history-v{HISTORY_VERSION}')
+        self.__histories: Dict[Tuple[int, str], RateHistory] = {}
+        self.__updating: Dict[Tuple[int, str], List[Callable]] = {}
+
+    def history(self, provider: int, base: str) -> RateHistory:
+        history = self.__histories.get((provider, base))
+        if history is None:
+            history = RateHistory(provider, base, os.path.join(self.directory, f'{provider}-{base}'))
+            self.__histories[(provider, base)] = history
+        else:
+            history.reload()
+        return history
+
+    def record(self, table) -> bool:
+        """ Append a freshly fetched latest table when it is the day right after the stored ones """
+        history = self.history(table.provider, table.base)
+        if not history.dates:
+            return False
+        provider = providers[table.provider]
+        following = provider.next_publication(provider.publication(history.last)).date()
+        if date.fromisoformat(table.date) != following:
+            return False
+        try:
+            return history.append([(table.date, table.rates)]) > 0
+        except OSError:
+            return False
+
+    def missing(self, provider: int, base: str) -> Optional[Tuple[date, date]]:
+        """ Range of days still to download, None when the history is up to date """
+        if providers[provider].history_source() is None:
+            return None
+        history = self.history(provider, base)
+        now = datetime.now(timezone.utc)
+        if history.dates:
+            provider = providers[provider]
+            if provider.next_publication(provider.publication(history.last)) > now:
+                return None
+            start = history.last + timedelta(days=1)
+        else:
+            start = date.fromisoformat(providers[provider].HISTORY_START)
+        return (start, now.date()) if start <= now.date() else None
+
+    def chunks(self, start: date, end: date) -> List[Tuple[str, str]]:
+        chunks = []
+        while start <= end:
+            chunk_end = min(start + timedelta(days=self.CHUNK_DAYS - 1), end)
+            chunks.append((start.isoformat(), chunk_end.isoformat()))
+            start = chunk_end + timedelta(days=1)
+        return chunks
+
+    def update(self, provider: int, base: str) -> RateHistory:
+        """ Download the missing days, one chunk at a time """
+        history = self.history(provider, base)
+        missing = self.missing(provider, base)
+        if missing is None:
+            return history
+        source = providers[provider].history_source()(base)
+        for start, end in self.chunks(*missing):
+            history.append(source.fetch(source.history_url(start, end), source.history_serializer))
+        return history
+
+    def update_async(self, provider: int, base: str, cancellable: Optional[Gio.Cancellable], callback: Callable):
+        """ Like update(), reporting callback(history, error) once every chunk has been appended.
+
+        Chunks are appended as they arrive, so an interrupted update resumes where it stopped.
+        """
+        key = (provider, base)
+        if key in self.__updating:
+            self.__updating[key].append(callback)
+            return
+        missing = self.missing(provider, base)
+        if missing is None:
+            return callback(self.history(provider, base), None)
+        self.__updating[key] = [callback]
+        source = providers[provider].history_source()(base)
+        chunks = self.chunks(*missing)
+
+        def finish(error: Optional[RequestError]):
+            history = self.history(provider, base)
+            for waiting in self.__updating.pop(key):
+                waiting(history, error)
+
+        def on_chunk(rows, error: Optional[RequestError]):
+            if error is not None:
+                return finish(error)
+            try:
+                self.history(provider, base).append(rows)
+            except OSError as error:
+                return finish(RequestError(str(error)))
+            next_chunk()
+
+        def next_chunk():
+            if not chunks:
+                return finish(None)
+            start, end = chunks.pop(0)
+            source.fetch_async(cancellable, on_chunk, source.history_url(start, end), source.history_serializer)
+
+        next_chunk()
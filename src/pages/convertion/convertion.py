@@ -18,20 +18,23 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import gi
+from datetime import date, timedelta
 from typing import Any, Dict, Union
 
 gi.require_version("Adw", "1")
 gi.require_version("Gtk", "4.0")
 
-from gi.repository import Adw, Gio, Gtk
-from ...components import CurrencySelector
+from gi.repository import Adw, Gio, GLib, Gtk
+from ...components import CurrencySelector, TrendChart
 from ...utils import CurrenciesListModel
-from ...define import RES_PATH, CODES
+from ...define import RES_PATH, currencies
+from ...profiling import tracer
 
 resource = f"{RES_PATH}/pages/convertion/index.ui"
 
 def convertion_page(application: Adw.Application, from_currency_value):
-    builder = Gtk.Builder.new_from_resource(resource)
+    with tracer.phase('page-builder'):
+        builder = Gtk.Builder.new_from_resource(resource)
     settings = application.utils.settings
     convertion = application.utils.convertion
     page = builder.get_object("toast_overlay")
@@ -42,32 +45,50 @@ def convertion_page(application: Adw.Application, from_currency_value):
     stack = builder.get_object("stack")
     reload = builder.get_object("reload")
     toast_overlay = builder.get_object("toast_overlay")
+    date_row = builder.get_object("date_row")
+    latest_button = builder.get_object("latest_button")
+    date_popover = builder.get_object("date_popover")
+    calendar = builder.get_object("calendar")
+    trend_row = builder.get_object("trend_row")
+    trend_stack = builder.get_object("trend_stack")
+    trend_chart: TrendChart = builder.get_object("trend_chart")
+    trend_chart.format_func = lambda rate: application.utils.format_number(rate) or str(rate)
+    ranges = {
+        builder.get_object("range_week"): timedelta(weeks=1),
+        builder.get_object("range_month"): timedelta(days=31),
+        builder.get_object("range_year"): timedelta(days=366),
+        builder.get_object("range_five_years"): timedelta(days=5 * 366),
+        builder.get_object("range_max"): None,
+    }
     to_currency_value = 0
+    convert_source = 0
     def load_currencies(provider: int):
-        codes = {currency: details for currency, details in CODES.items() if str(provider) in details['providers']}
-        from_currency_model = CurrenciesListModel(currency_names_func)
-        to_currency_model = CurrenciesListModel(currency_names_func)
-        from_currency_selector.bind_models(from_currency_model)
-        from_currency_model.set_currencies(codes)
-        to_currency_selector.bind_models(to_currency_model)
-        to_currency_model.set_currencies(codes)
-        if not settings.get_string('src-currency') in codes or not settings.get_string('dest-currency') in codes:
+        model = CurrenciesListModel.for_provider(provider, currency_names_func)
+        from_currency_selector.bind_models(model)
+        to_currency_selector.bind_models(model)
+        update_recent_currencies()
+        if not settings.get_string('src-currency') in model or not settings.get_string('dest-currency') in model:
             settings.set_string("src-currency", "USD")
             settings.set_string("dest-currency", "EUR")
 
         from_currency_selector.set_selected(settings.get_string('src-currency'))
         to_currency_selector.set_selected(settings.get_string('dest-currency'))
 
+    def update_recent_currencies(*_args):
+        recent = settings.get_strv('recent-currencies')
+        if from_currency_selector.model is not None:
+            from_currency_selector.model.set_recent(recent)
+        for selector in (from_currency_selector, to_currency_selector):
+            selector.resort()
+
     def change_provider(settings, key):
-        stack.set_visible_child_name("loading")
         load_currencies(settings.get_enum(key))
         convert(from_currency_entry.get_text(), force=True)
-
-    def is_loading():
-        return stack.get_visible_child_name() == "loading"
+        load_trend()
 
     def currency_names_func(code):
-        name = gettext(CODES.get(code, '')['name'])
+        currency = currencies().get(code)
+        name = currency.name if currency else ''
         return name if name else None
 
     def valid_from_currency_value(value: str):
@@ -80,26 +101,35 @@ def convertion_page(application: Adw.Application, from_currency_value):
             return False
 
     def convert(value, force=False):
-        if not is_loading() and value or force:
+        if value or force:
             value = application.utils.parse_number(value)
             if not value:
                 from_currency_entry.add_css_class("error")
                 return
             from_currency_entry.remove_css_class("error")
-            def thread_cb(task: Gio.Task, self, task_data: object, cancellable: Gio.Cancellable):
-                try:
-                    convertion.convert(float(value), from_currency_selector.selected, to_currency_selector.selected, settings.get_enum("providers"))
-                    task.return_value(self.__converted_data)
-                except Exception as e:
-                    task.return_value(e)
-            if convertion.converted_data["from"] != from_currency_selector.selected or convertion.converted_data["to"] != to_currency_selector.selected or not convertion.converted_data["converted"] or force:
+            provider = settings.get_enum("providers")
+            if not convertion.has_rate(from_currency_selector.selected, to_currency_selector.selected, provider, stale=True):
                 stack.set_visible_child_name("loading")
-                task = Gio.Task.new(application, None, None, None)
-                task.run_in_thread(thread_cb)
-            else:
-                convertion.convert(float(value), from_currency_selector.selected, to_currency_selector.selected, settings.get_enum("providers"))
+            convertion.convert_async(value, from_currency_selector.selected, to_currency_selector.selected, provider)
+
+    def queue_convert():
+        """ Collapse bursts of edits into one convertion, waiting longer when it needs the network """
+        nonlocal convert_source
+        if convert_source:
+            GLib.source_remove(convert_source)
+        delay = 0
+        if not convertion.has_rate(from_currency_selector.selected, to_currency_selector.selected, settings.get_enum("providers"), stale=True):
+            delay = settings.get_int("convertion-debounce")
+        convert_source = GLib.timeout_add(delay, run_queued_convert)
+
+    def run_queued_convert():
+        nonlocal convert_source
+        convert_source = 0
+        convert(from_currency_entry.get_text())
+        return GLib.SOURCE_REMOVE
 
     def converted(data: Dict[str, Union[str, int]]):
+        tracer.finish()
         if not data["converted"]:
             stack.set_visible_child_name("convertion-error")
             toast_overlay.add_toast(Adw.Toast.new(
@@ -107,12 +137,54 @@ def convertion_page(application: Adw.Application, from_currency_value):
             ))
         else:
             stack.set_visible_child_name("result")
-            result = application.utils.format_number(str(data["amount"]))
+            result = application.utils.format_number(data["amount"], data["to"] if data.get("high_precision") else None)
             if result:
                 to_currency_entry.set_text(result)
             else:
                 stack.set_visible_child_name("convertion-error")
 
+    def select_date(day):
+        """ Convert at a past day, or with the latest rates when day is None """
+        convertion.date = day
+        latest_button.set_visible(day is not None)
+        if day is None:
+            date_row.set_subtitle(_("Latest rates"))
+        else:
+            date_row.set_subtitle(GLib.DateTime.new_local(day.year, day.month, day.day, 0, 0, 0).format("%B %e, %Y"))
+        convert(from_currency_entry.get_text(), force=True)
+
+    def day_selected(calendar):
+        selected = calendar.get_date()
+        day = date(selected.get_year(), selected.get_month(), selected.get_day_of_month())
+        date_popover.popdown()
+        select_date(day if day < date.today() else None)
+
+    def load_trend(*_args):
+        """ Draw the selected range from the local history, downloading the missing days first """
+        if not trend_row.get_expanded():
+            return
+        provider = settings.get_enum("providers")
+        from_code = from_currency_selector.selected
+        to_code = to_currency_selector.selected
+        history = convertion.rates.history.history(provider, from_code)
+        if not history.dates:
+            trend_stack.set_visible_child_name("loading")
+        else:
+            show_trend(history, to_code)
+
+        def on_updated(history, error):
+            if from_currency_selector.selected == from_code and to_currency_selector.selected == to_code:
+                show_trend(history, to_code)
+
+        convertion.update_history(provider, from_code, on_updated)
+
+    def show_trend(history, to_code):
+        span = next(span for button, span in ranges.items() if button.get_active())
+        start = history.last - span if span is not None and history.dates else None
+        dates, rates = history.series(to_code, start)
+        trend_chart.set_series(dates, rates)
+        trend_stack.set_visible_child_name("chart" if len(trend_chart.xs) > 1 else "empty")
+
     def currency_selectors_changed(_obj, _param):
         from_code = from_currency_selector.selected
         to_code = to_currency_selector.selected
@@ -121,17 +193,26 @@ def convertion_page(application: Adw.Application, from_currency_value):
             settings.set_string('src-currency', from_code)
           if settings.get_string("dest-currency") != to_code:
             settings.set_string('dest-currency', to_code)
+          application.utils.add_recent_currencies(from_code, to_code)
           convert(from_currency_entry.get_text())
+          load_trend()
 
-    load_currencies(settings.get_enum("providers"))
-    from_currency_entry.connect('changed', lambda entry: convert(entry.get_text()))
+    with tracer.phase('currency-models'):
+        load_currencies(settings.get_enum("providers"))
+    from_currency_entry.connect('changed', lambda entry: queue_convert())
     from_currency_selector.connect('notify::selected', currency_selectors_changed)
     to_currency_selector.connect('notify::selected', currency_selectors_changed)
     reload.connect('clicked', lambda button: convert(from_currency_entry.get_text()))
+    calendar.connect('day-selected', day_selected)
+    latest_button.connect('clicked', lambda button: select_date(None))
+    trend_row.connect('notify::expanded', load_trend)
+    for button in ranges:
+        button.connect('toggled', lambda button: button.get_active() and load_trend())
     convertion.connect("converted", converted)
     settings.connect("changed::providers", change_provider)
     settings.connect("changed::src-currency", lambda settings, key: from_currency_selector.set_selected(settings.get_string(key)))
     settings.connect("changed::dest-currency", lambda settings, key: to_currency_selector.set_selected(settings.get_string(key)))
+    settings.connect("changed::recent-currencies", update_recent_currencies)
     settings.connect("changed::high-precision", lambda settings, key: convert(from_currency_entry.get_text()))
 
     if from_currency_value:
@@ -0,0 +1,253 @@
+# profiling.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+import json, os, time
+
+STARTUP_ENV = 'VALUTA_PROFILE_STARTUP'
+METRICS_ENV = 'VALUTA_METRICS'
+METRICS_INTERVAL_ENV = 'VALUTA_METRICS_INTERVAL'
+
+METRICS_INTERFACE = '''
+<node>
+  <interface name="io.github.idevecore.Valuta.Debug">
+    <method name="GetMetrics">
+      <arg type="s" name="snapshot" direction="out" />
+    </method>
+    <method name="ResetMetrics" />
+  </interface>
+</node>
+'''
+
+def write_json(path: str, data: dict):
+    """ Replace path atomically, readers never see a partial file """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, indent=2)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+class StartupTracer:
+    """ Named startup phases on the monotonic clock, written as JSON once the first result is shown """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.origin = time.monotonic_ns()
+        self.phases = []
+        self.finished = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and not self.finished
+
+    def enable(self, path: str):
+        if not self.finished:
+            self.path = path
+
+    def mark(self, name: str):
+        """ Record an instant, phases are always kept so an option parsed late still sees them """
+        if not self.finished:
+            now = time.monotonic_ns()
+            self.phases.append((name, now, now))
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            if not self.finished:
+                self.phases.append((name, start, time.monotonic_ns()))
+
+    def finish(self, name: str = 'first-result'):
+        if self.finished:
+            return
+        self.mark(name)
+        self.finished = True
+        if self.path:
+            self.write(self.path)
+        self.phases = []
+
+    def to_dict(self) -> dict:
+        to_ms = lambda ns: round((ns - self.origin) / 1e6, 3)
+        return {
+            "pid": os.getpid(),
+            "phases": [
+                {"name": name, "start_ms": to_ms(start), "duration_ms": round((end - start) / 1e6, 3)}
+                for name, start, end in self.phases
+            ],
+            "total_ms": to_ms(self.phases[-1][2]) if self.phases else 0,
+        }
+
+    def write(self, path: str):
+        write_json(path, self.to_dict())
+
+tracer = StartupTracer(os.environ.get(STARTUP_ENV))
+
+class Series:
+    """ Durations recorded under one span name, recent samples are kept for percentiles """
+    __slots__ = ('count', 'total', 'max', 'samples')
+    SAMPLES: int = 512
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, duration: int):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.samples.append(duration)
+
+    def to_dict(self) -> dict:
+        samples = sorted(self.samples)
+        to_ms = lambda ns: round(ns / 1e6, 3)
+        percentile = lambda percent: to_ms(samples[min(len(samples) - 1, int(len(samples) * percent / 100))])
+        return {
+            "count": self.count,
+            "total_ms": to_ms(self.total),
+            "mean_ms": to_ms(self.total / self.count),
+            "max_ms": to_ms(self.max),
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+        }
+
+class Span:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter_ns() - self.start)
+
+class Metrics:
+    """ Opt-in spans and counters of the conversion pipeline.
+
+    While disabled every call returns after checking enabled, spans are a shared no-op context.
+    """
+    NULL_SPAN = nullcontext()
+
+    def __init__(self, path: Optional[str] = None, interval: int = 10):
+        self.enabled = False
+        self.path = None
+        self.interval = interval
+        self.origin = time.monotonic_ns()
+        self.spans: Dict[str, Series] = {}
+        self.counters: Dict[str, int] = {}
+        self.__timer = 0
+        if path:
+            self.enable(path, interval)
+
+    def enable(self, path: Optional[str] = None, interval: Optional[int] = None):
+        """ Start collecting, writing a snapshot to path every interval seconds when one is given """
+        self.enabled = True
+        self.path = path or self.path
+        self.interval = interval or self.interval
+        if self.path and not self.__timer:
+            from gi.repository import GLib
+            self.__timer = GLib.timeout_add_seconds(self.interval, self.__on_interval)
+
+    def span(self, name: str):
+        return Span(self, name) if self.enabled else self.NULL_SPAN
+
+    def start(self) -> int:
+        """ Token for a span that ends in a callback, pass it to stop() """
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def stop(self, name: str, start: int):
+        if start:
+            self.observe(name, time.perf_counter_ns() - start)
+
+    def observe(self, name: str, duration: int):
+        if self.enabled:
+            series = self.spans.get(name)
+            if series is None:
+                series = self.spans[name] = Series()
+            series.add(duration)
+
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        self.spans = {}
+        self.counters = {}
+
+    def snapshot(self) -> dict:
+        ratios = {}
+        for name, hits in self.counters.items():
+            if name.endswith('.hit'):
+                prefix = name[:-len('.hit')]
+                total = hits + self.counters.get(f'{prefix}.miss', 0)
+                ratios[prefix] = round(hits / total, 4)
+        return {
+            "pid": os.getpid(),
+            "uptime_ms": round((time.monotonic_ns() - self.origin) / 1e6, 3),
+            "spans": {name: series.to_dict() for name, series in sorted(self.spans.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "hit_ratios": ratios,
+        }
+
+    def flush(self):
+        if self.enabled and self.path:
+            write_json(self.path, self.snapshot())
+
+    def register_dbus(self, connection, object_path: str) -> int:
+        """ Serve snapshots as JSON next to the application object, for debugging tools """
+        from gi.repository import Gio, GLib
+        interface = Gio.DBusNodeInfo.new_for_xml(METRICS_INTERFACE).interfaces[0]
+
+        def on_method_call(connection, sender, object_path, interface_name, method_name, parameters, invocation):
+            if method_name == 'GetMetrics':
+                invocation.return_value(GLib.Variant('(s)', (json.dumps(self.snapshot()),)))
+            else:
+                self.reset()
+                invocation.return_value(None)
+
+        return connection.register_object(
+            object_path=object_path,
+            interface_info=interface,
+            method_call_closure=on_method_call
+        )
+
+    def __on_interval(self) -> bool:
+        self.flush()
+        return True
+
+def metrics_interval(default: int = 10) -> int:
+    """ Seconds between snapshots, a malformed value must not keep the app from starting """
+    try:
+        interval = int(os.environ.get(METRICS_INTERVAL_ENV) or default)
+    except ValueError:
+        return default
+    return interval if interval > 0 else default
+
+metrics = Metrics(os.environ.get(METRICS_ENV), metrics_interval())
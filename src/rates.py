@@ -0,0 +1,299 @@
+# rates.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple, Union
+from array import array
+from decimal import Decimal
+import math, time
+from gi.repository import Gio, GObject
+from .requests import Requests, RequestError, providers
+from .cache import RateCache
+from .history import HistoryStore
+from .profiling import metrics
+
+LATEST = 'latest'
+NUMPY_THRESHOLD = 4096
+
+_numpy = False
+
+def numpy_module():
+    """ NumPy when it is installed, only imported for the first batch large enough to need it """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+class RateError(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+class BatchResult:
+    """ Amounts converted into several currencies from one table, one row of values per target.
+
+    Rows are NumPy float64 arrays for large batches when NumPy is installed, array('d') otherwise.
+    Targets missing from the table have a NaN rate and NaN values.
+    """
+    __slots__ = ('from_currency', 'targets', 'rates', 'values')
+
+    def __init__(self, from_currency: str, targets: Tuple[str, ...], rates: array, values: Sequence):
+        self.from_currency = from_currency
+        self.targets = targets
+        self.rates = rates
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, target: str):
+        return self.values[self.targets.index(target)]
+
+    def items(self) -> Iterable[Tuple[str, Sequence[float]]]:
+        return zip(self.targets, self.values)
+
+class RateTable:
+    """ Every rate published by a provider for one base currency """
+    __slots__ = ('provider', 'base', 'date', 'rates', 'exact_rates', 'url', 'expires')
+
+    def __init__(self, provider: int, base: str, date: str, rates: Dict[str, float], url: str = '', expires: Optional[float] = None):
+        self.provider = provider
+        self.base = base
+        self.date = date
+        # Rates are published as decimal strings, floats serve the fast path
+        self.exact_rates = {code: Decimal(str(value)) for code, value in rates.items()}
+        self.exact_rates[base] = Decimal(1)
+        self.rates = {code: float(value) for code, value in self.exact_rates.items()}
+        self.url = url
+        self.expires = providers[provider].expires(date) if expires is None else expires
+
+    @classmethod
+    def from_dict(cls, provider: int, data: Dict[str, Any]) -> 'RateTable':
+        return cls(provider, data["base"], data["date"], data["rates"], data.get("url", ''), data.get("expires"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "base": self.base,
+            "date": self.date,
+            "rates": {code: str(value) for code, value in self.exact_rates.items()},
+            "url": self.url,
+            "expires": self.expires,
+        }
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.rates
+
+    def rate(self, from_currency: str, to_currency: str) -> float:
+        """ Cross rate from_currency -> to_currency, derived locally """
+        return self.rates[to_currency] / self.rates[from_currency]
+
+    def exact_rate(self, from_currency: str, to_currency: str) -> Decimal:
+        return self.exact_rates[to_currency] / self.exact_rates[from_currency]
+
+    def cross_rates(self, from_currency: str, to_currencies: Iterable[str]) -> array:
+        """ rate() into every target at once, NaN for the targets missing from the table """
+        from_rate = self.rates[from_currency]
+        return array('d', (self.rates.get(code, math.nan) / from_rate for code in to_currencies))
+
+    def convert_many(self, amounts: Iterable[float], from_currency: str, to_currencies: Union[str, Iterable[str]]) -> BatchResult:
+        """ Every amount into every target, with one cross rate per target and no per-value Python work """
+        targets = (to_currencies,) if isinstance(to_currencies, str) else tuple(to_currencies)
+        rates = self.cross_rates(from_currency, targets)
+        numpy = None
+        if hasattr(amounts, 'dtype'):
+            numpy = numpy_module()
+        elif not (isinstance(amounts, array) and amounts.typecode == 'd'):
+            amounts = array('d', amounts)
+        if numpy is None and len(amounts) * len(targets) >= NUMPY_THRESHOLD:
+            numpy = numpy_module()
+        if numpy is not None:
+            values = numpy.outer(numpy.frombuffer(rates), numpy.asarray(amounts, dtype=numpy.float64))
+        else:
+            values = [array('d', map(rate.__mul__, amounts)) for rate in rates]
+        return BatchResult(from_currency, targets, rates, values)
+
+class RateFlight:
+    """ One outstanding table request and the callers waiting for it """
+
+    def __init__(self):
+        self.cancellable = Gio.Cancellable()
+        self.waiters = []
+
+    def wait(self, cancellable: Optional[Gio.Cancellable], callback: Callable):
+        if cancellable is not None and cancellable.is_cancelled():
+            return
+        waiter = [callback, cancellable, 0]
+        if cancellable is not None:
+            # Gio.Cancellable.connect() shadows the GObject signal API
+            waiter[2] = GObject.Object.connect(cancellable, 'cancelled', lambda _cancellable: self.__leave(waiter))
+        self.waiters.append(waiter)
+
+    def finish(self, table: Optional[RateTable], error: Optional[Exception]):
+        waiters, self.waiters = self.waiters, []
+        for callback, cancellable, handler in waiters:
+            if cancellable is not None:
+                GObject.signal_handler_disconnect(cancellable, handler)
+            callback(table, error)
+
+    def __leave(self, waiter: list):
+        waiters = [item for item in self.waiters if item is not waiter]
+        if len(waiters) != len(self.waiters):
+            self.waiters = waiters
+            if not waiters:
+                self.cancellable.cancel()
+
+class RateEngine:
+    LATE_PUBLICATION_RETRY: int = 15 * 60
+    FAILURE_BACKOFF: int = 30
+    MAX_FAILURE_BACKOFF: int = 15 * 60
+
+    def __init__(self, cache: Optional[RateCache] = None, history: Optional[HistoryStore] = None):
+        self.__tables: Dict[Tuple[int, str], RateTable] = {}
+        # (provider, base) -> (retry after, delay) of tables whose last download failed
+        self.__failures: Dict[Tuple[int, str], Tuple[float, float]] = {}
+        self.cache = cache if cache is not None else RateCache()
+        self.history = history if history is not None else HistoryStore()
+        self.__in_flight: Dict[Tuple[int, str, str], RateFlight] = {}
+        # Stamps of the cache files as last read or written, an expired table is only read again once rewritten
+        self.__stamps: Dict[Tuple[int, str], Any] = {}
+
+    def lookup(self, provider: int, from_currency: str, to_currency: str, stale: bool = False) -> Optional[RateTable]:
+        """ Return a table able to price the pair, from memory or disk, without touching the network.
+
+        Fresh tables are preferred, expired ones are only returned when stale is set.
+        """
+        fallback = None
+        for base in (from_currency, to_currency):
+            table = self.table(provider, base)
+            if table is not None and from_currency in table and to_currency in table:
+                if table.fresh:
+                    metrics.count('rates.lookup.hit')
+                    return table
+                fallback = fallback or table
+        for (table_provider, _base), table in self.__tables.items():
+            if table_provider == provider and from_currency in table and to_currency in table:
+                if table.fresh:
+                    metrics.count('rates.lookup.hit')
+                    return table
+                fallback = fallback or table
+        if fallback is not None and stale:
+            metrics.count('rates.lookup.stale')
+            return fallback
+        metrics.count('rates.lookup.miss')
+        return None
+
+    def fetch(self, provider: int, base: str) -> RateTable:
+        """ Download the whole rate table for base in a single request """
+        try:
+            response = Requests(provider, base).get()
+        except RequestError as error:
+            self.failed(provider, base)
+            raise RateError(error.message) from error
+        return self.store(RateTable.from_dict(provider, response))
+
+    def fetch_async(self, provider: int, base: str, cancellable: Gio.Cancellable, callback: Callable):
+        """ Like fetch(), reporting callback(table, error) from the main loop.
+
+        Concurrent callers for the same table wait on the single outstanding request,
+        which is only cancelled once every waiter has cancelled.
+        """
+        if cancellable is not None and cancellable.is_cancelled():
+            # Nobody would wait for the request, and a new flight would never be cancelled
+            return
+        key = (provider, base, LATEST)
+        flight = self.__in_flight.get(key)
+        if flight is None or flight.cancellable.is_cancelled():
+            flight = self.__in_flight[key] = RateFlight()
+            metrics.count('rates.flight.miss')
+
+            def on_response(response: Dict[str, Any], error: RequestError):
+                if self.__in_flight.get(key) is flight:
+                    del self.__in_flight[key]
+                if error is not None:
+                    if not error.cancelled:
+                        self.failed(provider, base)
+                    flight.finish(None, RateError(error.message))
+                else:
+                    flight.finish(self.store(RateTable.from_dict(provider, response)), None)
+
+            Requests(provider, base).get_async(flight.cancellable, on_response)
+        else:
+            metrics.count('rates.flight.hit')
+        flight.wait(cancellable, callback)
+
+    def failed(self, provider: int, base: str):
+        """ Back off from a table that could not be downloaded, doubling the delay while it keeps failing """
+        _retry, delay = self.__failures.get((provider, base), (0.0, self.FAILURE_BACKOFF / 2))
+        delay = min(delay * 2, self.MAX_FAILURE_BACKOFF)
+        self.__failures[(provider, base)] = (time.monotonic() + delay, delay)
+        metrics.count('rates.backoff')
+
+    def backing_off(self, provider: int, base: str) -> bool:
+        """ Whether the last download of the table failed too recently to try again in the background """
+        failure = self.__failures.get((provider, base))
+        return failure is not None and time.monotonic() < failure[0]
+
+    def store(self, table: RateTable) -> RateTable:
+        self.__failures.pop((table.provider, table.base), None)
+        if not table.fresh:
+            # The provider has not published the expected rates yet, try again a bit later
+            table.expires = time.time() + self.LATE_PUBLICATION_RETRY
+        self.__tables[(table.provider, table.base)] = table
+        self.cache.save(table.provider, table.base, table.to_dict())
+        self.__stamps[(table.provider, table.base)] = self.cache.stamp(table.provider, table.base)
+        self.history.record(table)
+        return table
+
+    def is_fresh(self, provider: int, base: str) -> bool:
+        table = self.table(provider, base)
+        return table is not None and table.fresh
+
+    def table(self, provider: int, base: str) -> Optional[RateTable]:
+        table = self.__tables.get((provider, base))
+        if table is None or not table.fresh:
+            stamp = self.cache.stamp(provider, base)
+            if stamp is None or stamp == self.__stamps.get((provider, base)):
+                metrics.count('rates.disk.miss' if stamp is None else 'rates.disk.unchanged')
+                return table
+            self.__stamps[(provider, base)] = stamp
+            data = self.cache.load(provider, base)
+            metrics.count('rates.disk.miss' if data is None else 'rates.disk.hit')
+            if data is not None:
+                try:
+                    cached = RateTable.from_dict(provider, data)
+                except (KeyError, TypeError, ValueError, ArithmeticError):
+                    return table
+                if table is None or cached.expires > table.expires:
+                    table = self.__tables[(provider, base)] = cached
+        return table
+
+    def get(self, provider: int, from_currency: str, to_currency: str) -> RateTable:
+        table = self.lookup(provider, from_currency, to_currency)
+        if table is None:
+            table = self.fetch(provider, from_currency)
+            if to_currency not in table:
+                raise RateError(f'{to_currency} is not available from {from_currency}')
+        return table
@@ -17,69 +17,343 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from typing import Any, Dict, Union
-from datetime import datetime
-import gi, json, re
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from datetime import datetime, timedelta
+from decimal import Decimal, Context
+from xml.etree import ElementTree
+from zoneinfo import ZoneInfo
+import gi, json, re, time
 gi.require_version('Soup', '3.0')
-from gi.repository import Soup, GLib
-from .define import BASE_URL_LANG_PREFIX, CODES
+from gi.repository import Gio, GObject, Soup, GLib
+from .define import BASE_URL_LANG_PREFIX
+from .profiling import metrics
 
-class Providers:
-    ECB_BASE_URL: str = 'https://api.frankfurter.app/latest'
-    response = {
-        "from": "",
-        "to": "",
-        "amount": "",
-        "converted": False,
-        "info": "",
-        "disclaimer": "",
-        "provider": "",
+class RequestError(Exception):
+    def __init__(self, message: str, cancelled: bool = False):
+        super().__init__(message)
+        self.message = message
+        self.cancelled = cancelled
+
+class SourceHealth:
+    """ Latency and failures of one source, ordering the sources and sizing the hedging delay """
+    ALPHA: float = 0.125
+    BETA: float = 0.25
+    HEDGE_DEFAULT: int = 1500
+    HEDGE_MIN: int = 250
+    HEDGE_MAX: int = 4000
+    MAX_FAILURES: int = 3
+    COOLDOWN: int = 5 * 60
+    __sources = {}
+
+    def __init__(self):
+        self.latency = None
+        self.deviation = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    @classmethod
+    def of(cls, name: str) -> 'SourceHealth':
+        health = cls.__sources.get(name)
+        if health is None:
+            health = cls.__sources[name] = cls()
+        return health
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, Any]]:
+        return {name: health.to_dict() for name, health in cls.__sources.items()}
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def success(self, latency: float):
+        """ Smoothed latency and deviation in milliseconds, as TCP estimates its round trip time """
+        if self.latency is None:
+            self.latency, self.deviation = latency, latency / 2
+        else:
+            self.deviation += self.BETA * (abs(latency - self.latency) - self.deviation)
+            self.latency += self.ALPHA * (latency - self.latency)
+        self.successes += 1
+        self.failures = 0
+        self.down_until = 0.0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.MAX_FAILURES:
+            self.down_until = time.monotonic() + self.COOLDOWN
+
+    def budget(self) -> int:
+        """ Milliseconds to wait for this source before a backup is fired """
+        if self.latency is None:
+            return self.HEDGE_DEFAULT
+        return int(min(max(self.latency + 4 * self.deviation, self.HEDGE_MIN), self.HEDGE_MAX))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latency_ms": round(self.latency, 1) if self.latency is not None else None,
+            "successes": self.successes,
+            "failures": self.failures,
+            "available": self.available,
+        }
+
+class Source(ABC):
+    """ One upstream publishing the rates of a provider, its payload is turned into a common response """
+    NAME: str = ''
+    HEADERS: Dict[str, str] = {
+        'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/117.0',
     }
 
-    def __init__(self, from_currency: str, to_currency: str, from_currency_value: int):
-        self.from_currency = from_currency
-        self.to_currency = to_currency
-        self.from_currency_value = from_currency_value
+    def __init__(self, base: str):
+        self.base = base
+        self.health = SourceHealth.of(self.NAME)
 
-    def mount_url(self):
+    @abstractmethod
+    def mount_url(self) -> str:
         pass
 
-    def serializer(self):
+    @abstractmethod
+    def serializer(self, data: bytes) -> Dict[str, Any]:
         pass
 
-    def default_response(self):
+    def default_response(self, base: str, date: str, rates: Dict[str, Decimal]) -> Dict[str, Any]:
+        return {
+            "base": base,
+            "date": date,
+            "rates": rates,
+            "url": self.mount_url(),
+        }
+
+    def response(self, message: Soup.Message, data: bytes, serializer: Callable) -> Any:
+        if message.get_status() != Soup.Status.OK:
+            raise RequestError(f'{self.NAME}: HTTP {message.get_status()} {message.get_reason_phrase() or ""}'.strip())
+        try:
+            with metrics.span('provider.serializer'):
+                return serializer(data)
+        except (ValueError, KeyError, TypeError, ArithmeticError, ElementTree.ParseError) as error:
+            raise RequestError(f'{self.NAME}: {error}') from error
+
+    def fetch(self, url: Optional[str] = None, serializer: Optional[Callable] = None) -> Any:
+        """ The serialized latest table, or the payload of another url of this source """
+        session = SoupSession.get_default()
+        message = session.create_request("GET", url or self.mount_url(), self.HEADERS)
+        start = time.monotonic()
+        try:
+            try:
+                data = session.get_response(message)
+            except GLib.GError as error:
+                raise RequestError(error.message) from error
+            response = self.response(message, data, serializer or self.serializer)
+        except RequestError:
+            self.health.failure()
+            metrics.count(f'sources.{self.NAME}.errors')
+            raise
+        latency = (time.monotonic() - start) * 1000
+        self.health.success(latency)
+        metrics.observe(f'sources.{self.NAME}', int(latency * 1e6))
+        return response
+
+    def fetch_async(self, cancellable: Gio.Cancellable, callback: Callable, url: Optional[str] = None, serializer: Optional[Callable] = None):
+        """ Call callback(response, error) from the main loop, cancellations do not count as failures """
+        session = SoupSession.get_default()
+        message = session.create_request("GET", url or self.mount_url(), self.HEADERS)
+        start = time.monotonic()
+
+        def on_response(data: bytes, error: GLib.GError):
+            if error is not None:
+                if error.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                    return callback(None, RequestError(error.message, cancelled=True))
+                request_error = RequestError(error.message)
+            else:
+                try:
+                    response = self.response(message, data, serializer or self.serializer)
+                except RequestError as error:
+                    request_error = error
+                else:
+                    latency = (time.monotonic() - start) * 1000
+                    self.health.success(latency)
+                    metrics.observe(f'sources.{self.NAME}', int(latency * 1e6))
+                    return callback(response, None)
+            self.health.failure()
+            metrics.count(f'sources.{self.NAME}.errors')
+            callback(None, request_error)
+
+        session.get_response_async(message, cancellable, on_response)
+
+class HistorySource(Source):
+    """ A source that also serves the tables of past days """
+
+    @abstractmethod
+    def history_url(self, start: str, end: str) -> str:
+        """ Every daily table published between start and end, both included """
+
+    @abstractmethod
+    def history_serializer(self, data: bytes) -> List[Tuple[str, Dict[str, Decimal]]]:
         pass
 
-    def create_info(self, date: str, time: str = "00:00:00"):
+class Frankfurter(HistorySource):
+    """ ECB reference rates as JSON, cross rates computed by the server """
+    NAME = 'frankfurter'
+    URL: str = 'https://api.frankfurter.app/latest'
+
+    def mount_url(self) -> str:
+        return f'{self.URL}?from={self.base}'
+
+    def serializer(self, data: bytes) -> Dict[str, Any]:
+        data = json.loads(data, parse_float=Decimal)
+        return self.default_response(data["base"], data["date"], data["rates"])
+
+    def history_url(self, start: str, end: str) -> str:
+        return f'{self.URL.rsplit("/", 1)[0]}/{start}..{end}?from={self.base}'
+
+    def history_serializer(self, data: bytes) -> List[Tuple[str, Dict[str, Decimal]]]:
+        return sorted(json.loads(data, parse_float=Decimal)["rates"].items())
+
+class ECBReference(Source):
+    """ The daily XML feed of the ECB itself, quoted against EUR, other bases are derived locally """
+    NAME = 'ecb-eurofxref'
+    URL: str = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml'
+    NAMESPACE: str = '{http://www.ecb.int/vocabulary/2002-08-01/eurofxref}'
+    CONTEXT = Context(prec=12)
+
+    def mount_url(self) -> str:
+        return self.URL
+
+    def serializer(self, data: bytes) -> Dict[str, Any]:
+        day = ElementTree.fromstring(data).find(f'{self.NAMESPACE}Cube/{self.NAMESPACE}Cube')
+        rates = {cube.get('currency'): Decimal(cube.get('rate')) for cube in day}
+        rates['EUR'] = Decimal(1)
+        base_rate = rates.pop(self.base)
+        rates = {code: self.CONTEXT.divide(rate, base_rate) for code, rate in rates.items()}
+        return self.default_response(self.base, day.get('time'), rates)
+
+class Providers:
+    """ A published set of rates, served by one or more interchangeable sources """
+    SOURCES: tuple = ()
+    HISTORY_START: str = ''
+    PUBLISH_TIMEZONE: str = 'UTC'
+    PUBLISH_TIME: tuple = (0, 0)
+
+    @staticmethod
+    def create_info(date: str, time: str = "00:00:00"):
         date = date.split("-")
         time = time.split(":")
         date_time = GLib.DateTime.new_local(float(date[0]), float(date[1]), float(date[2]), float(time[0]), float(time[1]), float(time[2]))
         return date_time.format("%B %e, %Y")
 
+    @classmethod
+    def history_source(cls) -> Optional[type]:
+        """ The first source serving past tables, None when the provider has no history """
+        return next((source for source in cls.SOURCES if issubclass(source, HistorySource)), None)
+
+    @classmethod
+    def is_publication_day(cls, day) -> bool:
+        return day.weekday() < 5
+
+    @classmethod
+    def publication(cls, day) -> datetime:
+        return datetime(day.year, day.month, day.day, *cls.PUBLISH_TIME, tzinfo=ZoneInfo(cls.PUBLISH_TIMEZONE))
+
+    @classmethod
+    def next_publication(cls, after: datetime) -> datetime:
+        """ First publication strictly after the given aware datetime """
+        day = after.astimezone(ZoneInfo(cls.PUBLISH_TIMEZONE)).date()
+        while not cls.is_publication_day(day) or cls.publication(day) <= after:
+            day += timedelta(days=1)
+        return cls.publication(day)
+
+    @classmethod
+    def expires(cls, date: str) -> float:
+        """ Timestamp of the first publication that replaces the rates of date """
+        return cls.next_publication(cls.publication(datetime.strptime(date, '%Y-%m-%d'))).timestamp()
+
+def easter_sunday(year: int) -> datetime:
+    """ Gregorian Easter, anonymous algorithm """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime(year, month, day + 1)
+
 class ECB(Providers):
-    def mount_url(self):
-        return f'{self.ECB_BASE_URL}?amount={self.from_currency_value}&from={self.from_currency}&to={self.to_currency}'
-
-    def serializer(self, data: bytes) -> Dict[str, Union[str, int]]:
-        return self.default_response(json.loads(data))
-
-    def default_response(self, data: Dict[str, str]):
-        self.response["base"] = data["rates"][self.to_currency]
-        self.response["from"] = self.from_currency
-        self.response["to"] = self.to_currency
-        self.response["amount"] = 0
-        self.response["info"] = self.create_info(data["date"])
-        self.response["disclaimer"] = self.mount_url()
-        self.response["provider"] = 0
-        return self.response
+    SOURCES = (Frankfurter, ECBReference)
+    HISTORY_START = '1999-01-04'
+    PUBLISH_TIMEZONE = 'Europe/Berlin'
+    PUBLISH_TIME = (16, 0)
+    CLOSING_DAYS = ((1, 1), (5, 1), (12, 25), (12, 26))
+
+    @classmethod
+    def is_publication_day(cls, day) -> bool:
+        """ No reference rates on weekends and TARGET closing days """
+        if day.weekday() >= 5 or (day.month, day.day) in cls.CLOSING_DAYS:
+            return False
+        easter = easter_sunday(day.year).date()
+        return day not in (easter - timedelta(days=2), easter + timedelta(days=1))
 
 providers = {
     0 : ECB,
 }
 
 class SoupSession(Soup.Session):
+    """ Process-wide keep-alive session, HTTP/2 is negotiated by libsoup through ALPN """
+    MAX_CONNS: int = 8
+    MAX_CONNS_PER_HOST: int = 4
+    IDLE_TIMEOUT: int = 90
+    TIMEOUT: int = 30
+    __default = None
+
     def __init__(self):
-        Soup.Session.__init__(self)
+        Soup.Session.__init__(
+            self,
+            max_conns=self.MAX_CONNS,
+            max_conns_per_host=self.MAX_CONNS_PER_HOST,
+            idle_timeout=self.IDLE_TIMEOUT,
+            timeout=self.TIMEOUT,
+        )
+        self.__connections = set()
+
+    @classmethod
+    def get_default(cls) -> 'SoupSession':
+        if cls.__default is None:
+            cls.__default = cls()
+        return cls.__default
+
+    def track_connection(self, message: Soup.Message):
+        """ A message sent over an already seen connection skipped the TCP and TLS handshakes """
+        connection_id = message.get_connection_id()
+        if not connection_id:
+            return
+        if connection_id in self.__connections:
+            metrics.count('http.pool.hit')
+        else:
+            self.__connections.add(connection_id)
+            metrics.count('http.pool.miss')
+
+    def record_metrics(self, message: Soup.Message):
+        """ Split the latency of a finished message into DNS, connect, TLS, waiting and download time """
+        timing = message.get_metrics()
+        if timing is None:
+            return
+
+        def observe(name: str, start: int, end: int):
+            # Soup reports monotonic microseconds, zero when the step did not happen
+            if start and end >= start:
+                metrics.observe(name, (end - start) * 1000)
+
+        observe('http.dns', timing.get_dns_start(), timing.get_dns_end())
+        observe('http.connect', timing.get_connect_start(), timing.get_connect_end())
+        observe('http.tls', timing.get_tls_start(), timing.get_connect_end())
+        observe('http.wait', timing.get_request_start(), timing.get_response_start())
+        observe('http.download', timing.get_response_start(), timing.get_response_end())
+        observe('http.total', timing.get_fetch_start(), timing.get_response_end())
+        metrics.count('http.bytes-received', timing.get_response_body_bytes_received())
 
     def create_request(self, method: str, url: str, headers: dict = {}) -> Soup.Message:
         """ Helper for creating Soup.Message """
@@ -89,28 +363,152 @@ class SoupSession(Soup.Session):
                 message.get_request_headers().append(name, value)
         if 'User-Agent' not in headers:
             message.get_request_headers().append('User-Agent', 'Currency Converter')
+        if metrics.enabled:
+            message.add_flags(Soup.MessageFlags.COLLECT_METRICS)
         return message
 
     def get_response(self, message: Soup.Message):
         response = None
         try:
-            response = self.send_and_read(message, None)
+            with metrics.span('http.get-response'):
+                response = self.send_and_read(message, None)
+            self.track_connection(message)
+            if metrics.enabled:
+                self.record_metrics(message)
             data = response.get_data()
             return data
         except GLib.GError as error:
              raise error from error
 
+    def get_response_async(self, message: Soup.Message, cancellable: Gio.Cancellable, callback: Callable):
+        """ Call callback(data, error) from the main loop once the body has been read """
+        def on_response(session: Soup.Session, result: Gio.AsyncResult):
+            try:
+                response = session.send_and_read_finish(result)
+            except GLib.GError as error:
+                metrics.count('http.errors')
+                return callback(None, error)
+            metrics.stop('http.get-response', start)
+            self.track_connection(message)
+            if metrics.enabled:
+                self.record_metrics(message)
+            callback(response.get_data(), None)
+
+        start = metrics.start()
+
+        self.send_and_read_async(message, GLib.PRIORITY_DEFAULT, cancellable, on_response)
+
+class HedgedFetch:
+    """ Race the sources of a provider: each backup starts once the previous source is late or failed,
+    the first response wins and the other requests are cancelled.
+    """
+
+    def __init__(self, sources: List[Source], cancellable: Optional[Gio.Cancellable], callback: Callable):
+        self.sources = list(sources)
+        self.cancellable = cancellable
+        self.callback = callback
+        self.attempts = []
+        self.errors = []
+        self.timer = 0
+        self.handler = 0
+        self.done = False
+        if cancellable is not None:
+            # Gio.Cancellable.connect() shadows the GObject signal API
+            self.handler = GObject.Object.connect(cancellable, 'cancelled', lambda _cancellable: self.__cancel())
+        if not self.__next():
+            # Cancelled before the first request, the callback still runs once and from the main loop
+            GLib.idle_add(self.__on_not_started)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancellable is not None and self.cancellable.is_cancelled()
+
+    def __next(self) -> bool:
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = 0
+        if not self.sources or self.cancelled:
+            return False
+        source = self.sources.pop(0)
+        attempt = Gio.Cancellable()
+        self.attempts.append(attempt)
+        source.fetch_async(attempt, lambda response, error: self.__on_response(attempt, response, error))
+        if self.sources:
+            self.timer = GLib.timeout_add(source.health.budget(), self.__on_late)
+        return True
+
+    def __on_not_started(self) -> bool:
+        if self.cancelled:
+            self.__finish(None, RequestError('Operation was cancelled', cancelled=True))
+        else:
+            self.__finish(None, RequestError('No source available'))
+        return GLib.SOURCE_REMOVE
+
+    def __on_late(self) -> bool:
+        self.timer = 0
+        metrics.count('requests.hedged')
+        self.__next()
+        return GLib.SOURCE_REMOVE
+
+    def __on_response(self, attempt: Gio.Cancellable, response: Optional[Dict[str, Any]], error: Optional[RequestError]):
+        self.attempts.remove(attempt)
+        if self.done:
+            return
+        if error is None:
+            return self.__finish(response, None)
+        self.errors.append(error)
+        if not error.cancelled:
+            metrics.count('requests.fallback')
+        if not self.attempts and not self.__next():
+            self.__finish(None, next((error for error in self.errors if not error.cancelled), self.errors[0]))
+
+    def __cancel(self):
+        for attempt in self.attempts:
+            attempt.cancel()
+
+    def __finish(self, response: Optional[Dict[str, Any]], error: Optional[RequestError]):
+        self.done = True
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = 0
+        if self.handler:
+            GObject.signal_handler_disconnect(self.cancellable, self.handler)
+            self.handler = 0
+        self.__cancel()
+        self.callback(response, error)
+
 class Requests:
-    HEADERS: Dict[str, str] = {
-        'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/117.0',
-    }
-    def __init__(self, provider: int, from_currency: str, to_currency: str, from_currency_value: int):
-        self.__provider = providers[provider](from_currency, to_currency, from_currency_value)
-        self.__url = self.__provider.mount_url()
-    def get(self):
-        session = SoupSession();
-        message = session.create_request("GET", self.__url, self.HEADERS)
-        try:
-            return self.__provider.serializer(session.get_response(message))
-        except Exception as error:
-            return error.message
+    """ Fetch the rates of a provider from the healthiest of its sources """
+
+    def __init__(self, provider: int, base: str):
+        self.__sources = [source(base) for source in providers[provider].SOURCES]
+
+    def sources(self) -> List[Source]:
+        """ Declared order, sources that keep failing are moved last until their cooldown ends """
+        return sorted(self.__sources, key=lambda source: not source.health.available)
+
+    def get(self) -> Dict[str, Any]:
+        """ Try every source in turn, raising the first RequestError when none answers """
+        errors = []
+        with metrics.span('requests.get'):
+            for source in self.sources():
+                try:
+                    return source.fetch()
+                except RequestError as error:
+                    metrics.count('requests.fallback')
+                    errors.append(error)
+        metrics.count('requests.errors')
+        raise errors[0] if errors else RequestError('No source available')
+
+    def get_async(self, cancellable: Gio.Cancellable, callback: Callable):
+        """ Same result as get(), handed to callback(response, error) without blocking the main loop """
+        start = metrics.start()
+
+        def on_response(response: Optional[Dict[str, Any]], error: Optional[RequestError]):
+            if error is not None:
+                metrics.count('requests.errors')
+            else:
+                metrics.stop('requests.get', start)
+            callback(response, error)
+
+        HedgedFetch(self.sources(), cancellable, on_response)
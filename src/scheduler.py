@@ -0,0 +1,102 @@
+# scheduler.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import List
+import time
+from gi.repository import Gio, GLib
+from .rates import RateEngine, RateTable
+
+class RefreshScheduler:
+    """ Prefetch the tables of the user's currencies right after the provider publishes them """
+    PUBLICATION_DELAY: int = 5 * 60
+    MAX_SLEEP: int = 60 * 60
+    RETRY_MIN: int = 60
+    RETRY_MAX: int = 60 * 60
+
+    def __init__(self, settings: Gio.Settings, rates: RateEngine):
+        self.settings = settings
+        self.rates = rates
+        self.__source = 0
+        self.__cancellable = None
+        self.__retry = 0
+        self.settings.connect("changed::providers", lambda settings, key: self.start())
+
+    def start(self):
+        self.stop()
+        self.__schedule(0)
+
+    def stop(self):
+        if self.__source:
+            GLib.source_remove(self.__source)
+            self.__source = 0
+        if self.__cancellable is not None:
+            self.__cancellable.cancel()
+            self.__cancellable = None
+
+    def bases(self) -> List[str]:
+        codes = [
+            self.settings.get_string('src-currency'),
+            *self.settings.get_strv('recent-currencies'),
+            *self.settings.get_strv('favorite-currencies'),
+        ]
+        return list(dict.fromkeys(codes))
+
+    def __schedule(self, seconds: float):
+        self.__source = GLib.timeout_add_seconds(max(0, int(seconds)), self.__tick)
+
+    def __next_check(self, provider: int, bases: List[str]) -> float:
+        """ Sleep until just after the earliest expiry, waking up regularly in case the system was suspended """
+        tables = [self.rates.table(provider, base) for base in bases]
+        expires = [table.expires for table in tables if table is not None]
+        if not expires:
+            return self.MAX_SLEEP
+        return min(min(expires) + self.PUBLICATION_DELAY - time.time(), self.MAX_SLEEP)
+
+    def __tick(self):
+        self.__source = 0
+        provider = self.settings.get_enum('providers')
+        bases = self.bases()
+        outdated = [base for base in bases if not self.rates.is_fresh(provider, base)]
+        if outdated and self.__cancellable is None:
+            self.__refresh(provider, bases, outdated)
+        else:
+            self.__schedule(self.__next_check(provider, bases))
+        return GLib.SOURCE_REMOVE
+
+    def __refresh(self, provider: int, bases: List[str], outdated: List[str]):
+        cancellable = self.__cancellable = Gio.Cancellable()
+        pending = len(outdated)
+        failed = False
+
+        def on_fetched(table: RateTable, error: Exception):
+            nonlocal pending, failed
+            pending -= 1
+            failed = failed or error is not None
+            if pending:
+                return
+            self.__cancellable = None
+            if failed:
+                self.__retry = min(max(self.__retry * 2, self.RETRY_MIN), self.RETRY_MAX)
+                self.__schedule(self.__retry)
+            else:
+                self.__retry = 0
+                self.__schedule(self.__next_check(provider, bases))
+
+        for base in outdated:
+            self.rates.fetch_async(provider, base, cancellable, on_fetched)
@@ -17,42 +17,137 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from typing import Any, Dict, Union, Callable
-from gi.repository import Adw, Gio, GObject, GLib
-from babel.numbers import format_number, parse_decimal
-from .requests import Requests
-from .define import CODES
+from typing import Any, Dict, Iterable, Optional, Sequence, Union, Callable
+from datetime import date
+from decimal import Decimal, Context, ROUND_HALF_EVEN
+import copy, functools, math, unicodedata
+from gi.repository import Gio, GObject, GLib
+from .requests import Providers, providers
+from .rates import RateEngine, RateTable
+from .history import RateHistory
+from .define import currencies, provider_currencies, minor_units
+from .profiling import metrics, tracer
+
+_babel_numbers = None
+
+def babel_numbers():
+    """ Babel is only imported once a number is parsed or shown """
+    global _babel_numbers
+    if _babel_numbers is None:
+        with tracer.phase('babel-import'):
+            import babel.numbers
+        _babel_numbers = babel.numbers
+    return _babel_numbers
+
+class NumberFormat:
+    """ Formatting and parsing bound to one locale, patterns and symbols are resolved once """
+    FALLBACK_LOCALE: str = 'en_US'
+
+    def __init__(self, locale: str):
+        numbers = babel_numbers()
+        from babel.core import UnknownLocaleError
+        try:
+            self.locale = numbers.Locale.parse(locale)
+        except (ValueError, TypeError, UnknownLocaleError):
+            self.locale = numbers.Locale.parse(self.FALLBACK_LOCALE)
+        self.decimal_symbol = numbers.get_decimal_symbol(self.locale)
+        self.group_symbol = numbers.get_group_symbol(self.locale)
+        # Non-breaking group separators are typed as plain spaces
+        self.group_symbols = (self.group_symbol, ' ') if self.group_symbol.isspace() else (self.group_symbol,)
+        self.pattern = self.locale.decimal_formats[None]
+        self.__patterns = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def for_locale(locale: str) -> 'NumberFormat':
+        return NumberFormat(locale)
+
+    def currency_pattern(self, code: str):
+        """ The decimal pattern with exactly as many fraction digits as the currency minor unit """
+        digits = minor_units(code)
+        pattern = self.__patterns.get(digits)
+        if pattern is None:
+            pattern = self.__patterns[digits] = copy.copy(self.pattern)
+            pattern.frac_prec = (digits, digits)
+        return pattern
+
+    def format(self, number, currency: str = None) -> str:
+        if not isinstance(number, Decimal):
+            number = Decimal(str(number))
+        if currency is not None:
+            return self.currency_pattern(currency).apply(quantize(number, currency), self.locale)
+        return self.pattern.apply(number, self.locale)
+
+    def parse(self, text: str) -> Decimal:
+        """ Parse a number typed in this locale, raising ValueError when it is not one """
+        text = text.strip()
+        for symbol in self.group_symbols:
+            text = text.replace(symbol, '')
+        try:
+            number = Decimal(text.replace(self.decimal_symbol, '.'))
+        except ArithmeticError:
+            raise ValueError(text)
+        if not number.is_finite():
+            raise ValueError(text)
+        return number
+
+@functools.lru_cache(maxsize=None)
+def quantizer(code: str):
+    """ Exponent and context used to round amounts of a currency to its ISO 4217 minor unit """
+    return Decimal(1).scaleb(-minor_units(code)), Context(rounding=ROUND_HALF_EVEN)
+
+def quantize(amount: Decimal, code: str) -> Decimal:
+    exponent, context = quantizer(code)
+    return amount.quantize(exponent, context=context)
 
 class CurrencyObject(GObject.Object):
     __gtype_name__ = 'CurrencyObject'
 
+    NOT_RECENT = 1 << 30
+
     code = GObject.Property(type=str)
     name = GObject.Property(type=str)
-    selected = GObject.Property(type=bool, default=False)
+    recent = GObject.Property(type=int, default=NOT_RECENT)
 
-    def __init__(self, code, name, selected=False):
+    def __init__(self, code, name):
         super().__init__()
         self.code = code
         self.name = name
-        self.selected = selected
 
     def __str__(self):
         return self.code
 
 class CurrenciesListModel(GObject.GObject, Gio.ListModel):
+    """ Currencies of one provider, built once and shared by every selector """
     __gtype_name__ = 'CurrenciesListModel'
 
-    def __init__(self, names_func):
+    __models: Dict[int, 'CurrenciesListModel'] = {}
+
+    def __init__(self, names_func, currencies=()):
         super().__init__()
 
         self.names_func = names_func
-        self.currencies = []
+        self.currencies = tuple(CurrencyObject(code, names_func(code)) for code in currencies)
+        self.index = {item.code: position for position, item in enumerate(self.currencies)}
+        self.search_index = None
+
+    @classmethod
+    def for_provider(cls, provider: int, names_func) -> 'CurrenciesListModel':
+        model = cls.__models.get(provider)
+        if model is None:
+            model = cls.__models[provider] = cls(names_func, provider_currencies(provider))
+        return model
 
     def __iter__(self):
         return iter(self.currencies)
 
+    def __contains__(self, code):
+        return code in self.index
+
     def do_get_item(self, position):
-        return self.currencies[position]
+        if position < len(self.currencies):
+            return self.currencies[position]
+        return None
 
     def do_get_item_type(self):
         return CurrencyObject
@@ -60,16 +155,56 @@ class CurrenciesListModel(GObject.GObject, Gio.ListModel):
     def do_get_n_items(self):
         return len(self.currencies)
 
-    def set_currencies(self, currencies):
-        removed = len(self.currencies)
-        self.currencies.clear()
-        for code in currencies:
-            self.currencies.append(CurrencyObject(code, self.names_func(code)))
-        self.items_changed(0, removed, len(self.currencies))
+    def get_search_index(self) -> 'CurrencySearchIndex':
+        if self.search_index is None:
+            self.search_index = CurrencySearchIndex(self.index)
+        return self.search_index
+
+    def get_currency(self, code):
+        position = self.index.get(code)
+        return None if position is None else self.currencies[position]
 
-    def set_selected(self, code):
+    def set_recent(self, codes):
+        """ Rank recently used currencies, the sorters have to be told to sort again """
+        ranks = {code: rank for rank, code in enumerate(codes)}
         for item in self.currencies:
-            item.props.selected = (item.code == code)
+            rank = ranks.get(item.code, CurrencyObject.NOT_RECENT)
+            if item.recent != rank:
+                item.recent = rank
+
+class CurrencySearchIndex:
+    """ Accent and case folded search keys for codes, localized and English names, symbols and aliases """
+    ALIASES: Dict[str, tuple] = {
+        "USD": ("dollar", "buck"),
+        "EUR": ("euro",),
+        "GBP": ("pound", "sterling", "quid"),
+        "JPY": ("yen",),
+        "CNY": ("yuan", "renminbi", "rmb"),
+        "CHF": ("franc",),
+        "INR": ("rupee",),
+        "RUB": ("ruble", "rouble"),
+        "BRL": ("real",),
+        "KRW": ("won",),
+    }
+
+    def __init__(self, codes: Iterable[str]):
+        records = currencies()
+        self.keys: Dict[str, str] = {}
+        for code in codes:
+            fields = [code, *self.ALIASES.get(code, ())]
+            currency = records.get(code)
+            if currency is not None:
+                fields += [currency.name, currency.msgid, currency.symbol]
+            self.keys[code] = '\0'.join(map(self.normalize, fields))
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        decomposed = unicodedata.normalize('NFKD', text)
+        return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+    def match(self, code: str, query: str) -> bool:
+        """ Prefix or substring match of an already normalized query """
+        return not query or query in self.keys.get(code, '')
 
 class Convertion:
     def __init__(self, settings: Gio.Settings):
@@ -82,58 +217,149 @@ class Convertion:
             "disclaimer": "",
             "provider": settings.get_enum("providers"),
             "converted": False,
+            "stale": False,
+            "date": None,
         }
         self.__events = {
             "converted": [],
         }
         self.settings = settings
-    def convert(self, from_currency_value: int, from_currency: str, to_currency: str, provider: int) -> Dict[str, Union[str, int]]:
-        if not from_currency == to_currency:
-            if not self.match_data(from_currency, to_currency, provider) or not self.converted_data["converted"]:
-                try:
-                  response = Requests(provider, from_currency, to_currency, 1).get()
-                  if isinstance(response, str):
-                      self.converted_data["converted"] = False
-                      return self.__event('converted', self.converted_data)
-                  self.converted_data = response
-                  self.converted_data["converted"] = True
-
-                  from_currency = from_currency_value
-                  base_currency = self.converted_data["base"]
-
-                  self.converted_data = {**self.converted_data, "amount": from_currency * base_currency}
-                  self.__event('converted', self.converted_data)
-                  return self.converted_data
-                except Exception as error:
-                  self.converted_data["converted"] = False
-                  self.converted_data = {**self.converted_data, "amount": 0}
-                  self.__event('converted', self.converted_data)
-                  return self.converted_data
-            else:
-              self.converted_data = {**self.converted_data, "amount": from_currency_value * self.converted_data["base"]}
-              self.__event('converted', self.converted_data)
-        else:
-            self.converted_data["converted"] = False
+        self.rates = RateEngine()
+        self.high_precision = settings.get_boolean("high-precision")
+        settings.connect("changed::high-precision", self.__on_high_precision_changed)
+        self.date = None
+        self.__cancellable = None
 
-    def convert_raw(self, from_currency_value: int, from_currency: str, to_currency: str, provider: int) -> int:
-        if not from_currency == to_currency:
-            response = Requests(provider, from_currency, to_currency, 1).get()
-            if not isinstance(response, str):
-                return response["base"]
-            else:
+    def convert_async(self, from_currency_value: int, from_currency: str, to_currency: str, provider: int):
+        """ Convert without blocking, a newer call cancels the older one so only the latest result is emitted.
+
+        An expired table is still used to answer at once, marked as stale, while a fresh one is fetched
+        in the background and emitted quietly when it arrives.
+        """
+        previous, self.__cancellable = self.__cancellable, None
+        try:
+            if from_currency == to_currency:
                 self.converted_data["converted"] = False
-        else:
-            self.converted_data["converted"] = False
+                return
+            if self.date is not None:
+                return self.__convert_at(from_currency_value, from_currency, to_currency, provider, self.date)
+            table = self.rates.lookup(provider, from_currency, to_currency, stale=True)
+            if table is not None:
+                with metrics.span('convertion.convert'):
+                    self.converted_data = self.create_data(table, from_currency_value, from_currency, to_currency)
+                    self.__event('converted', self.converted_data)
+                if table.fresh:
+                    return
+                metrics.count('convertion.stale')
+                if self.rates.backing_off(provider, table.base):
+                    # The last refresh failed, keep answering from the expired table until the backoff ends
+                    return
 
-    def match_data(self, from_currency: str, to_currency: str, provider: int) -> bool:
-        if self.converted_data["from"] != from_currency:
-            return False
-        if self.converted_data["to"] != to_currency:
-            return False
-        if self.converted_data["provider"] != provider:
-            return False
+            stale = table
+            cancellable = self.__cancellable = Gio.Cancellable()
+
+            def on_fetched(table: RateTable, error: Exception):
+                metrics.stop('convertion.fetch', start)
+                if cancellable.is_cancelled():
+                    return
+                self.__cancellable = None
+                if error is not None or to_currency not in table or from_currency not in table:
+                    if stale is not None:
+                        return
+                    self.converted_data = {**self.converted_data, "amount": 0, "converted": False}
+                else:
+                    self.converted_data = self.create_data(table, from_currency_value, from_currency, to_currency)
+                self.__event('converted', self.converted_data)
+
+            start = metrics.start()
+            # Joining before cancelling the previous call keeps a shared fetch alive while typing
+            self.rates.fetch_async(provider, stale.base if stale is not None else from_currency, cancellable, on_fetched)
+        finally:
+            if previous is not None:
+                previous.cancel()
+
+    def __convert_at(self, from_currency_value, from_currency: str, to_currency: str, provider: int, day: date):
+        """ Convert with the rates in force on a past day, downloading the missing history first """
+        history = self.rates.history.history(provider, from_currency)
+        cancellable = self.__cancellable = Gio.Cancellable()
+
+        def on_history(history: RateHistory, error: Exception):
+            if cancellable.is_cancelled():
+                return
+            self.__cancellable = None
+            found = history.lookup(to_currency, day)
+            if found is None:
+                self.converted_data = {**self.converted_data, "amount": 0, "converted": False}
+            else:
+                published, rate = found
+                # Past rates never expire, the disclaimer links to the day they were published
+                table = RateTable(provider, from_currency, published.isoformat(), {to_currency: rate}, self.history_url(provider, from_currency, published), math.inf)
+                self.converted_data = {**self.create_data(table, from_currency_value, from_currency, to_currency), "date": published}
+            self.__event('converted', self.converted_data)
+
+        if history.covers(day):
+            return on_history(history, None)
+        # The download is shared and resumable, a newer convertion only stops waiting for it
+        self.rates.history.update_async(provider, from_currency, None, on_history)
+
+    def history_url(self, provider: int, from_currency: str, day: date) -> str:
+        source = providers[provider].history_source()
+        return source(from_currency).history_url(day.isoformat(), day.isoformat()) if source is not None else ''
+
+    def series(self, provider: int, from_currency: str, to_currency: str, start: Optional[date] = None):
+        """ Stored dates and from -> to rates since start, as views of the history columns """
+        return self.rates.history.history(provider, from_currency).series(to_currency, start)
+
+    def update_history(self, provider: int, from_currency: str, callback: Callable):
+        """ Download the missing days of from_currency, then call callback(history, error) """
+        self.rates.history.update_async(provider, from_currency, None, callback)
+
+    def amount(self, table: RateTable, from_currency_value, from_currency: str, to_currency: str):
+        """ Converted amount, as a Decimal rounded to the currency minor unit in high precision mode """
+        if self.high_precision:
+            return self.scale(from_currency_value, table.exact_rate(from_currency, to_currency), to_currency)
+        return self.scale(from_currency_value, table.rate(from_currency, to_currency), to_currency)
+
+    def cross_rates(self, table: RateTable, from_currency: str, to_currencies: Iterable[str]) -> Sequence:
+        """ Rate into each target, exact Decimals in high precision mode, batched otherwise """
+        if self.high_precision:
+            return [table.exact_rate(from_currency, code) for code in to_currencies]
+        return table.cross_rates(from_currency, to_currencies)
+
+    def scale(self, from_currency_value, rate, to_currency: str):
+        """ amount() at a rate already looked up with cross_rates() """
+        if isinstance(rate, Decimal):
+            if not isinstance(from_currency_value, Decimal):
+                from_currency_value = Decimal(str(from_currency_value))
+            return quantize(from_currency_value * rate, to_currency)
+        return float(from_currency_value) * rate
+
+    def create_data(self, table: RateTable, from_currency_value: int, from_currency: str, to_currency: str) -> Dict[str, Union[str, int]]:
+        if self.high_precision:
+            base = table.exact_rate(from_currency, to_currency)
         else:
-            return True
+            base = table.rate(from_currency, to_currency)
+        return {
+            "base": base,
+            "from": from_currency,
+            "to": to_currency,
+            "amount": self.amount(table, from_currency_value, from_currency, to_currency),
+            "high_precision": self.high_precision,
+            "info": Providers.create_info(table.date),
+            "disclaimer": table.url,
+            "provider": table.provider,
+            "converted": True,
+            "stale": not table.fresh,
+            "date": None,
+        }
+
+    def has_rate(self, from_currency: str, to_currency: str, provider: int, stale: bool = False) -> bool:
+        if self.date is not None:
+            return self.rates.history.history(provider, from_currency).covers(self.date)
+        return self.rates.lookup(provider, from_currency, to_currency, stale) is not None
+
+    def __on_high_precision_changed(self, settings: Gio.Settings, key: str):
+        self.high_precision = settings.get_boolean(key)
 
     def connect(self, event: str, callback: Callable):
         self.__events[event].append(callback)
@@ -142,6 +368,12 @@ class Convertion:
         return self.converted_data
 
     def __event(self, event: str, data: Dict[str, Union[str, int]]):
+        if metrics.enabled:
+            with metrics.span(f'convertion.{event}'):
+                for listener in self.__events[event]:
+                    with metrics.span(f'listeners.{event}.{getattr(listener, "__qualname__", "listener")}'):
+                        listener(data)
+            return
         for listener in self.__events[event]:
             listener(data)
 
@@ -151,27 +383,52 @@ class Settings(Gio.Settings):
         super().__init__(*args)
 
 class Utils:
+    RECENT_CURRENCIES: int = 5
+
     def __init__(self, application_id):
         self.settings = Settings(application_id)
         self.convertion = Convertion(self.settings)
         self.locale = GLib.get_locale_variants(GLib.get_language_names()[0])
-        self.currencies = CODES
+        self.__number_format = None
         self.providers = {
           "0": "ECB"
         }
-    def format_number(self, number):
+
+    @property
+    def currencies(self):
+        return currencies()
+
+    def add_recent_currencies(self, *codes: str):
+        """ Move codes to the front of the recent currencies, the most recent first, with a single write """
+        recent = self.settings.get_strv('recent-currencies')
+        updated = list(dict.fromkeys([*codes, *recent]))[:self.RECENT_CURRENCIES]
+        if updated != recent:
+            self.settings.set_strv('recent-currencies', updated)
+
+    @property
+    def number_format(self) -> NumberFormat:
+        if self.__number_format is None:
+            self.__number_format = NumberFormat.for_locale(self.locale[1] if len(self.locale) > 1 else self.locale[0])
+        return self.__number_format
+
+    def format_number(self, number, currency: str = None):
+        """ Format for display, with the minor unit digits of currency when it is given.
+
+        Zero is a valid amount, an amount rounded to the minor unit can be one.
+        """
+        if number is None or number is False or number == '':
+            return False
         try:
-            if number:
-                return format_number(number, locale=self.locale[1])
-            else:
-                return False
-        except:
+            with metrics.span('numbers.format'):
+                return self.number_format.format(number, currency=currency)
+        except (ValueError, ArithmeticError):
+            return False
+
+    def parse_number(self, number: str):
+        if not number:
             return False
-    def parse_number(self, number):
         try:
-            if number:
-                return parse_decimal(number, locale=self.locale[1])
-            else:
-                return False
-        except:
+            with metrics.span('numbers.parse'):
+                return self.number_format.parse(number)
+        except ValueError:
             return False
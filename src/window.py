@@ -27,6 +27,7 @@ gi.require_version("Gtk", "4.0")
 from typing import Union, Any, Dict
 from gi.repository import Adw, Gdk, Gio, GLib, Gtk
 from .define import RES_PATH
+from .profiling import tracer
 from .pages import convertion_page
 from .components import Shortcuts
 
@@ -41,7 +42,8 @@ def string_to_color(string: str):
     return colors[string]
 
 def create_main_window(application: Adw.Application, from_currency_value: int):
-    builder = Gtk.Builder.new_from_resource(resource)
+    with tracer.phase('window-builder'):
+        builder = Gtk.Builder.new_from_resource(resource)
     settings = application.utils.settings
     convertion = application.utils.convertion
     window = builder.get_object("window")
@@ -52,6 +54,7 @@ def create_main_window(application: Adw.Application, from_currency_value: int):
     providers_action_group = Gio.SimpleActionGroup.new();
     window.insert_action_group("window", providers_action_group);
     providers_action_group.add_action(settings.create_action('providers'));
+    providers_action_group.add_action(settings.create_action('high-precision'));
 
     def load_window_state():
         settings.bind(
@@ -81,7 +84,10 @@ def create_main_window(application: Adw.Application, from_currency_value: int):
         window.set_help_overlay(Shortcuts())
 
     def converted(data: Dict[str, Union[str, int]]):
-        info.set_text(f'{data["info"]} -')
+        if data.get("stale"):
+            info.set_text(f'{_("Last updated {date}").format(date=data["info"])} -')
+        else:
+            info.set_text(f'{data["info"]} -')
         source.set_label(application.utils.settings.get_string("providers").upper())
         source.set_uri(convertion.get_convertion()['disclaimer'])
         source.set_visible(True)
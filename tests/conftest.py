@@ -0,0 +1,54 @@
+# conftest.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+The sources are imported as the installed valuta package, with define.py configured from
+define.in the way meson does it, so the tests run without a build directory.
+"""
+
+import os, re, shutil, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES = os.path.join(ROOT, 'src')
+CONFIGURATION = {
+    'APP_ID': 'io.github.idevecore.Valuta',
+    'VERSION': 'test',
+    'PROFILE': 'Devel',
+    'PYTHON': sys.executable,
+}
+
+def configure(text: str, directory: str) -> str:
+    return re.sub(r'@(\w+)@', lambda match: CONFIGURATION.get(match.group(1), directory), text)
+
+def pytest_configure(config):
+    directory = tempfile.mkdtemp(prefix='valuta-tests-')
+    package = os.path.join(directory, 'valuta')
+    shutil.copytree(SOURCES, package, ignore=shutil.ignore_patterns('*.in', '*.blp', 'meson.build', 'assets', 'search_provider', '__pycache__'))
+    with open(os.path.join(SOURCES, 'define.in'), encoding='utf-8') as source:
+        define = configure(source.read(), directory)
+    with open(os.path.join(package, 'define.py'), 'w', encoding='utf-8') as output:
+        output.write(define)
+    sys.path.insert(0, directory)
+    config.valuta_directory = directory
+
+def pytest_unconfigure(config):
+    directory = getattr(config, 'valuta_directory', None)
+    if directory is not None:
+        sys.path.remove(directory)
+        shutil.rmtree(directory, ignore_errors=True)
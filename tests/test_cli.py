@@ -0,0 +1,97 @@
+# test_cli.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import io, json
+import pytest
+
+pytest.importorskip('gi')
+
+from valuta import cli
+from valuta.history import RateHistory
+from valuta.rates import RateTable
+
+@pytest.fixture
+def latest():
+    table = RateTable(0, 'EUR', '2024-01-02', {'USD': '1.1', 'JPY': '160'}, expires=0)
+    return cli.Converter('EUR', 'USD', 2, table=table)
+
+@pytest.fixture
+def dated(tmp_path):
+    history = RateHistory(0, 'EUR', str(tmp_path / '0-EUR'))
+    history.append([('2024-01-02', {'USD': 1.1}), ('2024-01-03', {'USD': 1.2})])
+    return cli.Converter('EUR', 'USD', 2, history=history)
+
+def convert_csv(converter, text, column='amount', date_column=None):
+    output = io.StringIO()
+    count = cli.convert_csv(io.StringIO(text), output, converter, column, 'amount_USD', date_column, ',')
+    return count, output.getvalue().splitlines()
+
+def convert_jsonl(converter, text, date_column=None):
+    output = io.StringIO()
+    count = cli.convert_jsonl(io.StringIO(text), output, converter, 'amount', 'amount_USD', date_column)
+    return count, output.getvalue().splitlines()
+
+def test_csv_counts_bad_amounts_as_failed(latest):
+    count, lines = convert_csv(latest, 'id,amount\n1,10\n2,abc\n3\n4,2.5\n5,inf\n')
+    assert count == 5
+    assert lines == ['id,amount,amount_USD', '1,10,11.00', '2,abc,', '3,', '4,2.5,2.75', '5,inf,']
+    assert latest.failed == 3
+
+def test_csv_column_by_index(latest):
+    assert convert_csv(latest, 'id,amount\n1,10\n', column='1')[1][1] == '1,10,11.00'
+
+def test_csv_unknown_column(latest):
+    with pytest.raises(SystemExit):
+        convert_csv(latest, 'id,amount\n1,10\n', column='price')
+
+def test_csv_empty_input(latest):
+    assert convert_csv(latest, '') == (0, [])
+
+def test_csv_at_the_date_of_each_row(dated):
+    count, lines = convert_csv(dated, 'amount,booked\n10,2024-01-02\n10,2024-01-04T12:00\n10,2023-12-31\n10,soon\n10\n', date_column='booked')
+    assert count == 5
+    assert [line.rsplit(',', 1)[1] for line in lines[1:]] == ['11.00', '12.00', '', '', '']
+    assert dated.failed == 3
+
+def test_jsonl_passes_malformed_lines_through(latest):
+    count, lines = convert_jsonl(latest, '{"amount": 2}\nnot json\n[1, 2]\n\n{"amount": "x"}\n{}\n')
+    assert count == 5
+    rows = [json.loads(line) for line in lines]
+    assert rows[0] == {'amount': 2, 'amount_USD': 2.2}
+    assert rows[1] == {'line': 'not json', 'amount_USD': None}
+    assert rows[2] == {'line': '[1, 2]', 'amount_USD': None}
+    assert rows[3] == {'amount': 'x', 'amount_USD': None}
+    assert rows[4] == {'amount_USD': None}
+    assert latest.failed == 4
+
+def test_jsonl_keeps_the_formatted_digits(latest):
+    _count, lines = convert_jsonl(latest, '{"amount": 0.1}\n{"amount": 10, "amount_USD": "old"}\n')
+    assert lines == ['{"amount": 0.1, "amount_USD": 0.11}', '{"amount": 10, "amount_USD": 11.00}']
+
+def test_jsonl_dates_of_any_type(dated):
+    count, lines = convert_jsonl(dated, '\n'.join([
+        '{"amount": 10, "booked": "2024-01-03"}',
+        '{"amount": 10, "booked": ["2024-01-03"]}',
+        '{"amount": 10, "booked": {"day": 3}}',
+        '{"amount": 10, "booked": 3}',
+        '{"amount": 10}',
+    ]) + '\n', date_column='booked')
+    assert count == 5
+    assert [json.loads(line)['amount_USD'] for line in lines] == [12.0, None, None, None, None]
+    assert dated.failed == 4
@@ -0,0 +1,120 @@
+# test_history.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from array import array
+from datetime import date, timedelta
+import math, os
+import pytest
+
+pytest.importorskip('gi')
+
+from valuta.history import COLUMN_SUFFIX, DATES, HistoryStore, RateHistory
+
+@pytest.fixture
+def history(tmp_path):
+    return RateHistory(0, 'EUR', str(tmp_path / '0-EUR'))
+
+@pytest.fixture
+def filled(history):
+    history.append([('2024-01-02', {'USD': 1.0}), ('2024-01-03', {'USD': 2.0}), ('2024-01-05', {'USD': 3.0})])
+    return history
+
+def test_append_sorts_and_skips_stored_days(history):
+    assert history.append([('2024-01-03', {'USD': 1.2}), ('2024-01-02', {'USD': 1.1})]) == 2
+    assert history.append([('2024-01-03', {'USD': 9.0}), ('2024-01-04', {'USD': 1.3})]) == 1
+    assert history.append([]) == 0
+    assert list(history.column('USD')) == [1.1, 1.2, 1.3]
+    assert (history.first, history.last) == (date(2024, 1, 2), date(2024, 1, 4))
+
+def test_new_currency_is_padded_with_nan(history):
+    history.append([('2024-01-02', {'USD': 1.1})])
+    history.append([('2024-01-03', {'USD': 1.2, 'JPY': 150.0})])
+    jpy = list(history.column('JPY'))
+    assert len(jpy) == 2 and math.isnan(jpy[0]) and jpy[1] == 150.0
+    assert history.rate('JPY', date(2024, 1, 2)) is None
+    assert history.rate('JPY', date(2024, 1, 3)) == 150.0
+    assert sorted(history.codes()) == ['JPY', 'USD']
+
+def test_currency_missing_from_a_day_is_nan(history):
+    history.append([('2024-01-02', {'USD': 1.1, 'JPY': 150.0}), ('2024-01-03', {'USD': 1.2})])
+    assert history.rate('JPY', date(2024, 1, 2)) == 150.0
+    assert history.rate('JPY', date(2024, 1, 3)) is None
+
+def test_interrupted_append_is_dropped(history):
+    history.append([('2024-01-02', {'USD': 1.1})])
+    # A writer stopped after growing a column, and halfway through a day of the dates column
+    with open(os.path.join(history.directory, 'USD' + COLUMN_SUFFIX), 'ab') as file:
+        array('d', [7.0, 8.0]).tofile(file)
+    with open(os.path.join(history.directory, DATES), 'ab') as file:
+        file.write(b'\x01\x02')
+
+    reader = RateHistory(0, 'EUR', history.directory)
+    assert len(reader) == 1
+    assert list(reader.column('USD')) == [1.1]
+    assert reader.append([('2024-01-03', {'USD': 1.2})]) == 1
+    assert list(reader.column('USD')) == [1.1, 1.2]
+    assert reader.last == date(2024, 1, 3)
+    assert os.path.getsize(os.path.join(history.directory, DATES)) == 2 * 4
+    assert os.path.getsize(os.path.join(history.directory, 'USD' + COLUMN_SUFFIX)) == 2 * 8
+
+def test_stale_writer_keeps_committed_rows(history):
+    other = RateHistory(0, 'EUR', history.directory)
+    history.append([('2024-01-02', {'USD': 1.1})])
+    assert other.append([('2024-01-02', {'USD': 9.0}), ('2024-01-03', {'USD': 1.2})]) == 1
+    history.reload()
+    assert list(history.column('USD')) == [1.1, 1.2]
+
+def test_lookup_uses_the_last_publication(filled):
+    assert filled.lookup('USD', date(2024, 1, 1)) is None
+    assert filled.lookup('USD', date(2024, 1, 2)) == (date(2024, 1, 2), 1.0)
+    assert filled.lookup('USD', date(2024, 1, 4)) == (date(2024, 1, 3), 2.0)
+    assert filled.lookup('USD', date(2024, 1, 4), exact=True) is None
+    assert filled.lookup('USD', date(2030, 1, 1)) == (date(2024, 1, 5), 3.0)
+    assert filled.rate('EUR', date(2024, 1, 3)) == 1.0
+    assert filled.rate('GBP', date(2024, 1, 3)) is None
+
+def test_covers(filled):
+    assert not filled.covers(date(2024, 1, 1))
+    assert filled.covers(date(2024, 1, 4))
+    assert not filled.covers(date(2024, 1, 6))
+
+def test_series_includes_both_ends(filled):
+    dates, rates = filled.series('USD', date(2024, 1, 3), date(2024, 1, 5))
+    assert [date.fromordinal(day) for day in dates] == [date(2024, 1, 3), date(2024, 1, 5)]
+    assert list(rates) == [2.0, 3.0]
+    assert list(filled.series('USD')[1]) == [1.0, 2.0, 3.0]
+    assert list(filled.series('USD', start=date(2024, 1, 4))[1]) == [3.0]
+    assert len(filled.series('USD', start=date(2024, 1, 6))[0]) == 0
+    assert len(filled.series('USD', end=date(2024, 1, 1))[0]) == 0
+    assert len(filled.series('GBP')[1]) == 0
+
+def test_chunks_cover_the_range(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    chunks = [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in store.chunks(date(1999, 1, 4), date(2001, 6, 30))]
+    assert chunks[0][0] == date(1999, 1, 4)
+    assert chunks[-1][1] == date(2001, 6, 30)
+    for (_start, end), (following, _end) in zip(chunks, chunks[1:]):
+        assert following - end == timedelta(days=1)
+    for start, end in chunks:
+        assert start <= end and (end - start).days < store.CHUNK_DAYS
+
+def test_chunks_of_one_day_and_of_nothing(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    assert store.chunks(date(2024, 1, 2), date(2024, 1, 2)) == [('2024-01-02', '2024-01-02')]
+    assert store.chunks(date(2024, 1, 3), date(2024, 1, 2)) == []
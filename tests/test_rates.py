@@ -0,0 +1,221 @@
+# test_rates.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from array import array
+from decimal import Decimal
+import math
+import pytest
+
+pytest.importorskip('gi')
+
+from gi.repository import Gio
+from valuta import rates
+from valuta.cache import RateCache
+from valuta.history import HistoryStore
+from valuta.rates import RateEngine, RateTable
+from valuta.requests import RequestError
+
+RESPONSE = {"base": "EUR", "date": "2024-01-02", "rates": {"USD": "1.1"}, "url": ""}
+
+@pytest.fixture
+def table():
+    return RateTable(0, 'EUR', '2024-01-02', {'USD': '1.1', 'JPY': '160'}, expires=0)
+
+@pytest.fixture
+def without_numpy(monkeypatch):
+    monkeypatch.setattr(rates, 'numpy_module', lambda: None)
+
+@pytest.fixture
+def engine(tmp_path):
+    return RateEngine(RateCache(str(tmp_path / 'rates')), HistoryStore(str(tmp_path / 'history')))
+
+@pytest.fixture
+def requests(monkeypatch):
+    """ Requests started by the engine, as (base, cancellable, callback), answered by the test """
+    started = []
+
+    class Requests:
+        def __init__(self, provider, base):
+            self.base = base
+
+        def get_async(self, cancellable, callback):
+            started.append((self.base, cancellable, callback))
+
+    monkeypatch.setattr(rates, 'Requests', Requests)
+    return started
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rates.time, 'monotonic', lambda: now[0])
+    return now
+
+def test_cross_rates(table):
+    assert table.rate('USD', 'JPY') == pytest.approx(160 / 1.1)
+    assert table.exact_rate('USD', 'JPY') == Decimal('160') / Decimal('1.1')
+    assert table.exact_rate('EUR', 'EUR') == 1
+    many = table.cross_rates('USD', ('EUR', 'JPY', 'GBP'))
+    assert list(many[:2]) == pytest.approx([1 / 1.1, 160 / 1.1]) and math.isnan(many[2])
+
+def test_table_round_trips_through_its_dict(table):
+    copy = RateTable.from_dict(0, table.to_dict())
+    assert copy.exact_rates == table.exact_rates
+    assert copy.expires == table.expires
+
+def test_convert_many_without_numpy(table, without_numpy):
+    result = table.convert_many([1.0, 2.5], 'USD', ('EUR', 'JPY', 'GBP'))
+    assert result.targets == ('EUR', 'JPY', 'GBP')
+    assert len(result) == 3
+    assert all(isinstance(values, array) for values in result.values)
+    assert list(result['EUR']) == pytest.approx([1 / 1.1, 2.5 / 1.1])
+    assert list(result['JPY']) == pytest.approx([160 / 1.1, 400 / 1.1])
+    assert math.isnan(result.rates[2]) and all(math.isnan(value) for value in result['GBP'])
+
+def test_convert_many_into_one_code(table, without_numpy):
+    result = table.convert_many(array('d', [2.0]), 'EUR', 'USD')
+    assert result.targets == ('USD',)
+    assert list(result['USD']) == pytest.approx([2.2])
+
+def test_convert_many_of_nothing(table, without_numpy):
+    result = table.convert_many([], 'EUR', ('USD', 'JPY'))
+    assert [len(values) for values in result.values] == [0, 0]
+
+def test_convert_many_with_numpy_matches_arrays(table, monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    amounts = [0.5, 1.0, 2.5, 1e6]
+    expected = {code: list(values) for code, values in table.convert_many(amounts, 'USD', ('EUR', 'JPY')).items()}
+
+    result = table.convert_many(numpy.array(amounts), 'USD', ('EUR', 'JPY'))
+    assert result.values.shape == (2, len(amounts))
+    for code, values in result.items():
+        assert list(values) == pytest.approx(expected[code])
+
+    # Plain sequences switch to NumPy from the threshold on
+    monkeypatch.setattr(rates, 'NUMPY_THRESHOLD', 1)
+    result = table.convert_many(amounts, 'USD', ('EUR', 'JPY'))
+    assert isinstance(result.values, numpy.ndarray)
+    assert list(result['JPY']) == pytest.approx(expected['JPY'])
+
+def test_second_caller_joins_the_flight(engine, requests):
+    answers = []
+    engine.fetch_async(0, 'EUR', None, lambda table, error: answers.append((table, error)))
+    engine.fetch_async(0, 'EUR', Gio.Cancellable(), lambda table, error: answers.append((table, error)))
+    assert len(requests) == 1
+
+    _base, _cancellable, callback = requests[0]
+    callback(RESPONSE, None)
+    assert len(answers) == 2
+    assert all(error is None and table.rates['USD'] == 1.1 for table, error in answers)
+
+    # The answered flight is gone, the next caller starts a new request
+    engine.fetch_async(0, 'EUR', None, lambda table, error: None)
+    assert len(requests) == 2
+
+def test_flights_are_per_base(engine, requests):
+    engine.fetch_async(0, 'EUR', None, lambda table, error: None)
+    engine.fetch_async(0, 'USD', None, lambda table, error: None)
+    assert [base for base, _cancellable, _callback in requests] == ['EUR', 'USD']
+
+def test_request_is_cancelled_by_the_last_waiter(engine, requests):
+    first, second = Gio.Cancellable(), Gio.Cancellable()
+    answers = []
+    engine.fetch_async(0, 'EUR', first, lambda table, error: answers.append('first'))
+    engine.fetch_async(0, 'EUR', second, lambda table, error: answers.append('second'))
+    _base, flight, callback = requests[0]
+
+    first.cancel()
+    assert not flight.is_cancelled()
+    second.cancel()
+    assert flight.is_cancelled()
+
+    callback(None, RequestError('Operation was cancelled', cancelled=True))
+    assert answers == []
+    assert not engine.backing_off(0, 'EUR')
+
+def test_cancelled_caller_starts_no_flight(engine, requests):
+    cancellable = Gio.Cancellable()
+    cancellable.cancel()
+    engine.fetch_async(0, 'EUR', cancellable, lambda table, error: pytest.fail('called back'))
+    assert requests == []
+
+    # A later caller is not joined to an orphan flight
+    engine.fetch_async(0, 'EUR', None, lambda table, error: None)
+    assert len(requests) == 1 and not requests[0][1].is_cancelled()
+
+def test_failed_flight_backs_off(engine, requests, clock):
+    errors = []
+    engine.fetch_async(0, 'EUR', None, lambda table, error: errors.append(error))
+    requests[0][2](None, RequestError('HTTP 503'))
+    assert errors[0].message == 'HTTP 503'
+    assert engine.backing_off(0, 'EUR')
+    assert not engine.backing_off(0, 'USD')
+
+def test_backoff_doubles_up_to_the_maximum(engine, clock):
+    delay = engine.FAILURE_BACKOFF
+    while delay <= engine.MAX_FAILURE_BACKOFF:
+        engine.failed(0, 'EUR')
+        start = clock[0]
+        clock[0] = start + delay - 1
+        assert engine.backing_off(0, 'EUR')
+        clock[0] = start + delay + 1
+        assert not engine.backing_off(0, 'EUR')
+        delay *= 2
+
+    engine.failed(0, 'EUR')
+    start = clock[0]
+    clock[0] = start + engine.MAX_FAILURE_BACKOFF - 1
+    assert engine.backing_off(0, 'EUR')
+    clock[0] = start + engine.MAX_FAILURE_BACKOFF + 1
+    assert not engine.backing_off(0, 'EUR')
+
+def test_store_clears_the_backoff(engine, clock):
+    engine.failed(0, 'EUR')
+    engine.failed(0, 'EUR')
+    engine.store(RateTable.from_dict(0, RESPONSE))
+    assert not engine.backing_off(0, 'EUR')
+
+    # And the delay starts over
+    engine.failed(0, 'EUR')
+    clock[0] += engine.FAILURE_BACKOFF + 1
+    assert not engine.backing_off(0, 'EUR')
+
+def test_late_publication_is_retried_soon(engine, monkeypatch):
+    # The rates of an old day are expired as soon as they are stored, the provider has not published yet
+    monkeypatch.setattr(rates.time, 'time', lambda: 2e9)
+    table = engine.store(RateTable.from_dict(0, RESPONSE))
+    assert table.expires == 2e9 + engine.LATE_PUBLICATION_RETRY
+    assert engine.table(0, 'EUR') is table
+
+def test_expired_table_is_read_again_only_once_rewritten(engine, monkeypatch):
+    loads = []
+    load = engine.cache.load
+    monkeypatch.setattr(engine.cache, 'load', lambda provider, base: loads.append(base) or load(provider, base))
+    assert engine.table(0, 'EUR') is None
+    assert loads == []
+
+    engine.cache.save(0, 'EUR', {**RESPONSE, "expires": 0})
+    for _attempt in range(3):
+        table = engine.table(0, 'EUR')
+        assert table is not None and not table.fresh
+    assert loads == ['EUR']
+
+    # Another process stored a newer table
+    engine.cache.save(0, 'EUR', {**RESPONSE, "rates": {"USD": "1.2"}, "expires": 1})
+    assert engine.table(0, 'EUR').rates['USD'] == 1.2
+    assert loads == ['EUR', 'EUR']
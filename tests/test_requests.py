@@ -0,0 +1,81 @@
+# test_requests.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+import pytest
+
+pytest.importorskip('gi')
+
+from valuta.requests import ECB, easter_sunday
+
+BERLIN = ZoneInfo('Europe/Berlin')
+
+def berlin(*args) -> datetime:
+    return datetime(*args, tzinfo=BERLIN)
+
+@pytest.mark.parametrize('year, sunday', [
+    (2019, date(2019, 4, 21)),
+    (2024, date(2024, 3, 31)),
+    (2025, date(2025, 4, 20)),
+    (2038, date(2038, 4, 25)),
+])
+def test_easter_sunday(year, sunday):
+    assert easter_sunday(year).date() == sunday
+
+@pytest.mark.parametrize('day', [
+    date(2024, 3, 30),  # Saturday
+    date(2024, 3, 31),  # Sunday
+    date(2024, 3, 29),  # Good Friday
+    date(2024, 4, 1),   # Easter Monday
+    date(2024, 1, 1),
+    date(2024, 5, 1),
+    date(2024, 12, 25),
+    date(2024, 12, 26),
+])
+def test_no_publication(day):
+    assert not ECB.is_publication_day(day)
+
+@pytest.mark.parametrize('day', [date(2024, 3, 28), date(2024, 4, 2), date(2024, 12, 24), date(2024, 12, 27)])
+def test_publication(day):
+    assert ECB.is_publication_day(day)
+
+def test_next_publication_before_and_after_the_cutoff():
+    assert ECB.next_publication(berlin(2024, 6, 4, 15, 59)) == berlin(2024, 6, 4, 16, 0)
+    assert ECB.next_publication(berlin(2024, 6, 4, 16, 0)) == berlin(2024, 6, 5, 16, 0)
+    assert ECB.next_publication(berlin(2024, 6, 4, 16, 1)) == berlin(2024, 6, 5, 16, 0)
+
+def test_next_publication_converts_to_berlin_time():
+    # 14:30 UTC is 16:30 in Berlin during summer time, after the cutoff
+    assert ECB.next_publication(datetime(2024, 6, 4, 14, 30, tzinfo=ZoneInfo('UTC'))) == berlin(2024, 6, 5, 16, 0)
+    # And 15:30 in winter, before it
+    assert ECB.next_publication(datetime(2024, 1, 9, 14, 30, tzinfo=ZoneInfo('UTC'))) == berlin(2024, 1, 9, 16, 0)
+
+def test_next_publication_skips_the_weekend_and_holidays():
+    assert ECB.next_publication(berlin(2024, 6, 7, 17, 0)) == berlin(2024, 6, 10, 16, 0)
+    # Maundy Thursday evening, the Easter closing runs from Good Friday to Easter Monday
+    assert ECB.next_publication(berlin(2024, 3, 28, 17, 0)) == berlin(2024, 4, 2, 16, 0)
+    assert ECB.next_publication(berlin(2024, 12, 24, 17, 0)) == berlin(2024, 12, 27, 16, 0)
+    assert ECB.next_publication(berlin(2024, 4, 30, 16, 0)) == berlin(2024, 5, 2, 16, 0)
+
+def test_rates_expire_at_the_next_publication():
+    assert ECB.expires('2024-06-04') == berlin(2024, 6, 5, 16, 0).timestamp()
+    assert ECB.expires('2024-06-07') == berlin(2024, 6, 10, 16, 0).timestamp()
+    assert ECB.expires('2024-03-28') == berlin(2024, 4, 2, 16, 0).timestamp()
+    assert ECB.expires('2024-12-24') == berlin(2024, 12, 27, 16, 0).timestamp()
@@ -0,0 +1,60 @@
+# test_trend_chart.py
+#
+# Copyright 2023 Ideve Core
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import importlib.util, math, os
+import pytest
+
+pytest.importorskip('cairo')
+gi = pytest.importorskip('gi')
+gi.require_version('Gtk', '4.0')
+
+import valuta
+
+def load_trend_chart():
+    """ The module alone, the components package loads templates from the compiled resources """
+    path = os.path.join(os.path.dirname(valuta.__file__), 'components', 'trend_chart', 'trend_chart.py')
+    spec = importlib.util.spec_from_file_location('trend_chart', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+lttb = load_trend_chart().lttb
+
+def test_short_series_are_kept():
+    xs, ys = [1, 2, 3], [1.0, 2.0, 3.0]
+    assert lttb(xs, ys, 3) == (xs, ys)
+    assert lttb(xs, ys, 10) == (xs, ys)
+    assert lttb(xs, ys, 2) == (xs, ys)
+
+def test_downsampled_to_the_threshold():
+    xs = list(range(1000))
+    ys = [math.sin(x / 40) for x in xs]
+    sampled_xs, sampled_ys = lttb(xs, ys, 100)
+    assert len(sampled_xs) == len(sampled_ys) == 100
+    assert (sampled_xs[0], sampled_xs[-1]) == (0, 999)
+    assert sampled_xs == sorted(set(sampled_xs))
+    assert all(ys[x] == y for x, y in zip(sampled_xs, sampled_ys))
+
+def test_spikes_survive():
+    xs = list(range(500))
+    ys = [1.0] * 500
+    ys[123] = 50.0
+    ys[321] = -50.0
+    sampled_xs, _ys = lttb(xs, ys, 20)
+    assert 123 in sampled_xs and 321 in sampled_xs